@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import tornado.web
+from telegram import Update
+from telegram.ext import Application
+
+import main
+
+# Стенд нагрузочного тестирования: бот собирается так же, как в main(), но
+# Bot API заменен локальной заглушкой, а пользователи — синтетическими
+# последовательностями /start → выбор шаблона → имя клиента.
+#
+#   python benchmark.py --users 20 --backends docx,zip,stamp --pool-sizes 1,2,4
+#
+# Для этапа конвертации нужен установленный LibreOffice.
+
+BENCH_TOKEN = "123456:benchmark"
+USER_ID_BASE = 10_000
+
+logger = logging.getLogger("benchmark")
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else None,
+    }
+
+class StageCollector(logging.Handler):
+    # Разбирает структурированные строки "trace event=stage ..." из логов бота
+    def __init__(self):
+        super().__init__(level=logging.INFO)
+        self.samples = {}
+
+    def emit(self, record):
+        message = record.getMessage()
+        if not message.startswith("trace event=stage "):
+            return
+        fields = dict(part.split("=", 1) for part in message.split()[1:] if "=" in part)
+        if fields.get("outcome") != "ok":
+            return
+        self.samples.setdefault(fields["stage"], []).append(float(fields["seconds"]))
+
+class FakeBotApi:
+    # Минимальная заглушка Telegram Bot API: отвечает на методы, которые
+    # вызывает бот, и раскладывает исходящие сообщения по чатам
+    def __init__(self):
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self.inboxes = {}
+        self.uploaded_bytes = 0
+
+    def inbox(self, chat_id):
+        return self.inboxes.setdefault(chat_id, asyncio.Queue())
+
+    def _message(self, chat_id, **extra):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    def handle(self, method, params, files):
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if method == "getMe":
+            return {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Benchmark",
+                "username": "benchmark_bot",
+                "can_join_groups": False,
+                "can_read_all_group_messages": False,
+                "supports_inline_queries": False,
+            }
+        if method in ("sendMessage", "editMessageText"):
+            self.inbox(chat_id).put_nowait((method, params.get("text", "")))
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "sendDocument":
+            document = files.get("document")
+            size = len(document[0]["body"]) if document else 0
+            self.uploaded_bytes += size
+            file_id = f"bench-file-{next(self._file_ids)}"
+            self.inbox(chat_id).put_nowait((method, file_id))
+            return self._message(
+                chat_id,
+                document={"file_id": file_id, "file_unique_id": file_id, "file_size": size},
+            )
+        if method == "editMessageReplyMarkup":
+            return self._message(chat_id)
+        return True
+
+class BotApiHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    def post(self, token, method):
+        params = {name: self.get_body_argument(name) for name in self.request.body_arguments}
+        result = self.api.handle(method, params, self.request.files)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"ok": True, "result": result}))
+
+class SimulatedUser:
+    def __init__(self, index, api, application, template_key, timeout):
+        self.user_id = USER_ID_BASE + index
+        self.api = api
+        self.application = application
+        self.template_key = template_key
+        self.timeout = timeout
+        self.inbox = api.inbox(self.user_id)
+        self._update_ids = itertools.count(index * 10)
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"User{self.user_id}"}
+
+    def _message(self, text, entities=None):
+        data = {
+            "message_id": next(self._update_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self._user(),
+            "text": text,
+        }
+        if entities:
+            data["entities"] = entities
+        return data
+
+    async def _send(self, payload):
+        payload["update_id"] = self.user_id * 100 + next(self._update_ids)
+        await self.application.update_queue.put(Update.de_json(payload, self.application.bot))
+
+    async def _expect(self, predicate):
+        while True:
+            method, value = await asyncio.wait_for(self.inbox.get(), self.timeout)
+            if predicate(method, value):
+                return method, value
+
+    async def run(self, client_name):
+        await self._send({
+            "message": self._message("/start", [{"type": "bot_command", "offset": 0, "length": 6}])
+        })
+        await self._expect(lambda method, text: method == "sendMessage" and "шаблон" in text)
+
+        await self._send({
+            "callback_query": {
+                "id": str(self.user_id),
+                "from": self._user(),
+                "chat_instance": str(self.user_id),
+                "message": self._message("Выберите шаблон:"),
+                "data": self.template_key,
+            }
+        })
+        await self._expect(lambda method, text: method == "sendMessage" and "имя клиента" in text)
+
+        started = time.perf_counter()
+        await self._send({"message": self._message(client_name)})
+        method, value = await self._expect(
+            lambda method, value: method == "sendDocument"
+            or (method == "sendMessage" and ("ошибка" in value or "много запросов" in value))
+        )
+        if method != "sendDocument":
+            raise RuntimeError(value)
+        return time.perf_counter() - started
+
+def configure_backend(backend, pool_size, template_key, cache_dir):
+    # Пересобирает глобальные сервисы бота под выбранный способ рендера и размер пула
+    main.converter_pool.close()
+    main.converter_pool = main.ConverterPool(pool_size, main.CONVERTER_MAX_JOBS, main.CONVERTER_TIMEOUT)
+    main.generation_executor.shutdown()
+    main.generation_executor = main.GenerationExecutor(pool_size, main.GENERATION_QUEUE_SIZE)
+    main.result_cache = main.ResultCache(cache_dir, main.RESULT_CACHE_MAX_BYTES)
+    main.SESSIONS_DB = os.path.join(cache_dir, "sessions.db")
+
+    main.TEMPLATE_ENGINES[template_key] = "docx" if backend == "docx" else "zip"
+    main.template_store = main.TemplateStore(main.TEMPLATES, main.TEMPLATES_DIR)
+    main.stamp_registry = main.StampRegistry({template_key} if backend == "stamp" else set())
+    template = main.template_store.get(template_key)
+    if backend == "stamp" and main.stamp_registry.layout(template) is None:
+        raise RuntimeError(f"Шаблон {template_key} не удалось откалибровать для штамповки")
+
+async def run_scenario(backend, pool_size, args, run_index):
+    collector = StageCollector()
+    main.logger.addHandler(collector)
+    api = FakeBotApi()
+    web_app = tornado.web.Application([(r"/bot([^/]+)/(\w+)", BotApiHandler, {"api": api})])
+    server = web_app.listen(args.api_port, address="127.0.0.1")
+    base_url = f"http://127.0.0.1:{args.api_port}/bot"
+
+    with tempfile.TemporaryDirectory(prefix="pdfbot_bench_") as cache_dir:
+        try:
+            configure_backend(backend, pool_size, args.template, cache_dir)
+            application = main.build_application(
+                Application.builder().token(BENCH_TOKEN).base_url(base_url).base_file_url(base_url)
+            )
+            async with application:
+                await application.start()
+                users = [
+                    SimulatedUser(index, api, application, args.template, args.timeout)
+                    for index in range(args.users)
+                ]
+                started = time.perf_counter()
+                results = await asyncio.gather(
+                    *(
+                        user.run(f"Bench Client {run_index}-{index}")
+                        for index, user in enumerate(users)
+                    ),
+                    return_exceptions=True,
+                )
+                wall = time.perf_counter() - started
+                await application.stop()
+        finally:
+            server.stop()
+            main.logger.removeHandler(collector)
+
+    latencies = [value for value in results if isinstance(value, float)]
+    errors = [repr(value) for value in results if not isinstance(value, float)]
+    return {
+        "backend": backend,
+        "pool_size": pool_size,
+        "users": args.users,
+        "completed": len(latencies),
+        "errors": errors,
+        "wall_seconds": wall,
+        "docs_per_second": len(latencies) / wall if wall else None,
+        "uploaded_bytes": api.uploaded_bytes,
+        "end_to_end": summarize(latencies),
+        "stages": {stage: summarize(values) for stage, values in collector.samples.items()},
+    }
+
+async def run_all(args):
+    results = []
+    run_index = itertools.count()
+    for backend in args.backends:
+        for pool_size in args.pool_sizes:
+            logger.info(f"Сценарий: {backend}, пул {pool_size}, пользователей {args.users}")
+            result = await run_scenario(backend, pool_size, args, next(run_index))
+            logger.info(
+                f"{backend}/{pool_size}: {result['docs_per_second'] or 0:.2f} док/с, "
+                f"p95 {result['end_to_end']['p95']}, ошибок {len(result['errors'])}"
+            )
+            results.append(result)
+    main.converter_pool.close()
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест генерации документов")
+    parser.add_argument("--users", type=int, default=10, help="одновременных пользователей")
+    parser.add_argument("--template", default="ur_recruitment", choices=sorted(main.TEMPLATES))
+    parser.add_argument("--backends", default="docx,zip,stamp",
+                        help="способы рендера через запятую: docx, zip, stamp")
+    parser.add_argument("--pool-sizes", default="1,2", help="размеры пула конвертеров через запятую")
+    parser.add_argument("--timeout", type=float, default=300, help="ожидание ответа бота, с")
+    parser.add_argument("--api-port", type=int, default=18081, help="порт заглушки Bot API")
+    parser.add_argument("--output", default="bench_results.json", help="файл с результатами")
+    args = parser.parse_args()
+    args.backends = [backend.strip() for backend in args.backends.split(",") if backend.strip()]
+    args.pool_sizes = [int(size) for size in args.pool_sizes.split(",") if size.strip()]
+    return args
+
+def run():
+    args = parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("tornado.access").setLevel(logging.WARNING)
+    results = asyncio.run(run_all(args))
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "template": args.template,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"Результаты сохранены в {args.output}")
+
+if __name__ == "__main__":
+    run()
@@ -1,46 +1,606 @@
 import os
+import io
+import json
+import signal
+import socket
+import sys
+import contextvars
+import re
+import csv
+import copy
 import uuid
+import hashlib
+import asyncio
+import functools
+import queue
+import threading
+import time
+import tempfile
+import pathlib
+import shutil
+import contextlib
+import zipfile
 import subprocess
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, time as dtime
+from xml.sax.saxutils import escape as xml_escape
 from zoneinfo import ZoneInfo
 import docx
+from docx.text.paragraph import Paragraph
+from lxml import etree
 import telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    PersistenceInput,
     filters,
     CallbackQueryHandler,
 )
 import sqlite3
 import logging
+import tornado.web
 from dateutil.parser import parse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest, start_http_server
+)
+
+# UNO доступен только при установленном python3-uno (см. Dockerfile)
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+    from com.sun.star.connection import NoConnectException
+except ImportError:
+    uno = None
+
+# Штамповка PDF требует pypdf и reportlab
+try:
+    from pypdf import PdfReader, PdfWriter
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas as pdf_canvas
+except ImportError:
+    PdfReader = None
+
+# Необязательная переупаковка PDF при постобработке
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+# Идентификатор задачи для трассировки запросов в логах
+current_job_id = contextvars.ContextVar("current_job_id", default="-")
+
+class JobIdFilter(logging.Filter):
+    def filter(self, record):
+        record.job_id = current_job_id.get()
+        return True
 
 # Настройка логирования
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    format="%(asctime)s - %(name)s - %(levelname)s - [%(job_id)s] %(message)s", level=logging.INFO
 )
+for log_handler in logging.getLogger().handlers:
+    log_handler.addFilter(JobIdFilter())
 logger = logging.getLogger(__name__)
 
+# Метрики в формате Prometheus, отдаются на /metrics
+STAGE_SECONDS = Histogram(
+    "pdfbot_stage_seconds",
+    "Длительность этапов генерации документа",
+    ["stage", "template", "outcome"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+HANDLER_SECONDS = Histogram(
+    "pdfbot_handler_seconds",
+    "Длительность обработчиков обновлений",
+    ["handler", "outcome"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+HANDLER_CALLS = Counter(
+    "pdfbot_handler_calls_total", "Вызовы обработчиков обновлений", ["handler", "outcome"]
+)
+GENERATIONS = Counter(
+    "pdfbot_generations_total", "Запросы на генерацию документа", ["template", "outcome"]
+)
+QUEUE_DEPTH = Gauge("pdfbot_generation_queue_depth", "Задачи, ожидающие в очереди генерации")
+GENERATIONS_IN_FLIGHT = Gauge("pdfbot_generations_in_flight", "Выполняющиеся генерации")
+CONVERSIONS_IN_FLIGHT = Gauge("pdfbot_conversions_in_flight", "Выполняющиеся конвертации LibreOffice")
+POSTPROCESS_RATIO = Histogram(
+    "pdfbot_postprocess_size_ratio",
+    "Отношение размера PDF после постобработки к исходному",
+    ["template"],
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.25),
+)
+POSTPROCESS_SAVED_BYTES = Counter(
+    "pdfbot_postprocess_saved_bytes_total", "Байты, сэкономленные постобработкой PDF", ["template"]
+)
+DURABLE_JOBS = Counter(
+    "pdfbot_durable_jobs_total", "Задачи долговременной очереди генерации", ["outcome"]
+)
+
+def trace(event, **fields):
+    details = " ".join(f"{name}={value}" for name, value in fields.items())
+    logger.info(f"trace event={event} {details}")
+
+@contextlib.contextmanager
+def observe_stage(stage, template_key):
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage=stage, template=template_key, outcome=outcome).observe(elapsed)
+        trace("stage", stage=stage, template=template_key, outcome=outcome, seconds=f"{elapsed:.3f}")
+
+def instrumented_handler(func):
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        current_job_id.set(uuid.uuid4().hex[:12])
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await func(update, context)
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.labels(handler=func.__name__, outcome=outcome).observe(elapsed)
+            HANDLER_CALLS.labels(handler=func.__name__, outcome=outcome).inc()
+            user_id = update.effective_user.id if update.effective_user else "-"
+            trace("handler", handler=func.__name__, user=user_id, outcome=outcome, seconds=f"{elapsed:.3f}")
+    return wrapper
+
 # Состояния бота
 SELECT_TEMPLATE, INPUT_NAME, CHANGE_DATE, INPUT_NEW_DATE, VIEW_BOOKMARKS, GENERATE_ANOTHER = range(6)
+BATCH_SELECT_TEMPLATE, BATCH_INPUT = range(6, 8)
 
-# Настройка базы данных
-def init_db():
-    conn = sqlite3.connect("bookmarks.db")
-    c = conn.cursor()
-    c.execute(
-        """CREATE TABLE IF NOT EXISTS bookmarks
-                 (user_id INTEGER, client_name TEXT, template_name TEXT, date TEXT)"""
-    )
-    conn.commit()
-    conn.close()
+# Хранилище закладок: одно долгоживущее соединение в режиме WAL,
+# все запросы выполняются в отдельном потоке вне цикла событий
+BOOKMARKS_DB = os.environ.get("BOOKMARKS_DB", "bookmarks.db")
+BOOKMARKS_PAGE_SIZE = int(os.environ.get("BOOKMARKS_PAGE_SIZE", 8))
+
+class BookmarkStore:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bookmarks")
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._migrate(conn)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _migrate(conn):
+        with conn:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(bookmarks)")]
+            if columns and "id" not in columns:
+                # Старая таблица без ключа: переносим строки, убирая дубли
+                conn.execute("ALTER TABLE bookmarks RENAME TO bookmarks_legacy")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS bookmarks
+                         (id INTEGER PRIMARY KEY,
+                          user_id INTEGER NOT NULL,
+                          client_name TEXT NOT NULL,
+                          template_name TEXT NOT NULL,
+                          date TEXT NOT NULL,
+                          UNIQUE (user_id, client_name, template_name, date))"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS bookmarks_user_date ON bookmarks (user_id, date)"
+            )
+            if columns and "id" not in columns:
+                conn.execute(
+                    """INSERT OR IGNORE INTO bookmarks (user_id, client_name, template_name, date)
+                       SELECT user_id, client_name, template_name, date
+                       FROM bookmarks_legacy ORDER BY rowid"""
+                )
+                conn.execute("DROP TABLE bookmarks_legacy")
+                logger.info("Таблица закладок перенесена на новую схему")
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _add(self, user_id, client_name, template_key, date):
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO bookmarks (user_id, client_name, template_name, date) VALUES (?, ?, ?, ?)",
+                (user_id, client_name, template_key, date)
+            )
+        return cursor.rowcount > 0
+
+    def _page(self, user_id, after_id, limit):
+        # Ключевая пагинация: новые даты первыми, курсор — id последней показанной записи
+        conn = self._connection()
+        if after_id:
+            rows = conn.execute(
+                """SELECT id, client_name, template_name, date FROM bookmarks
+                   WHERE user_id = ? AND (date, id) < (SELECT date, id FROM bookmarks WHERE id = ?)
+                   ORDER BY date DESC, id DESC LIMIT ?""",
+                (user_id, after_id, limit + 1)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                """SELECT id, client_name, template_name, date FROM bookmarks
+                   WHERE user_id = ? ORDER BY date DESC, id DESC LIMIT ?""",
+                (user_id, limit + 1)
+            ).fetchall()
+        return rows[:limit], len(rows) > limit
+
+    def _documents_page(self, user_id, after, limit):
+        # Различные пары клиент-шаблон по уникальному индексу, курсор — последняя пара
+        conn = self._connection()
+        if after:
+            rows = conn.execute(
+                """SELECT client_name, template_name FROM bookmarks
+                   WHERE user_id = ? AND (client_name, template_name) > (?, ?)
+                   GROUP BY client_name, template_name
+                   ORDER BY client_name, template_name LIMIT ?""",
+                (user_id, *after, limit + 1)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                """SELECT client_name, template_name FROM bookmarks WHERE user_id = ?
+                   GROUP BY client_name, template_name
+                   ORDER BY client_name, template_name LIMIT ?""",
+                (user_id, limit + 1)
+            ).fetchall()
+        return rows[:limit], len(rows) > limit
+
+    def _get(self, user_id, bookmark_id):
+        return self._connection().execute(
+            "SELECT id, client_name, template_name, date FROM bookmarks WHERE id = ? AND user_id = ?",
+            (bookmark_id, user_id)
+        ).fetchone()
+
+    async def add(self, user_id, client_name, template_key, date):
+        return await self._call(self._add, user_id, client_name, template_key, date)
+
+    async def page(self, user_id, after_id=0, limit=BOOKMARKS_PAGE_SIZE):
+        return await self._call(self._page, user_id, after_id, limit)
+
+    async def documents_page(self, user_id, after=None, limit=BOOKMARKS_PAGE_SIZE):
+        return await self._call(self._documents_page, user_id, after, limit)
+
+    async def get(self, user_id, bookmark_id):
+        return await self._call(self._get, user_id, bookmark_id)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+bookmark_store = BookmarkStore(BOOKMARKS_DB)
+
+# Сессии диалогов в SQLite: состояние ConversationHandler и user_data
+# переживают перезапуск и доступны всем репликам за вебхуком
+SESSIONS_DB = os.environ.get("SESSIONS_DB", "sessions.db")
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 24 * 60 * 60))
+SESSION_WRITE_INTERVAL = float(os.environ.get("SESSION_WRITE_INTERVAL", 2))
+SESSION_SWEEP_INTERVAL = int(os.environ.get("SESSION_SWEEP_INTERVAL", 10 * 60))
+
+class SessionPersistence(BasePersistence):
+    # Запись пакетная: Application раз в SESSION_WRITE_INTERVAL передает
+    # изменившиеся сессии, и все они сохраняются одной транзакцией. Чтение
+    # идет из памяти; записи других реплик подтягиваются перед обновлением,
+    # только если PRAGMA data_version показывает чужое изменение базы.
+    def __init__(self, path, ttl, write_interval):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=write_interval,
+        )
+        self.path = path
+        self.ttl = ttl
+        self.instance_id = uuid.uuid4().hex
+        self.application = None
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions")
+        self._pending_users = {}
+        self._pending_conversations = {}
+        self._write_task = None
+        self._data_version = None
+        self._seq = 0
+        self._remote_users = {}
+        self._last_seen = {}
+        self._evicted = {}
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # data IS NULL / state IS NULL — удаленная сессия, чтобы удаление
+            # увидели другие реплики
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS user_sessions
+                         (user_id INTEGER PRIMARY KEY,
+                          data TEXT,
+                          writer TEXT NOT NULL,
+                          seq INTEGER NOT NULL,
+                          updated_at REAL NOT NULL)"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS conversations
+                         (name TEXT NOT NULL,
+                          key TEXT NOT NULL,
+                          state INTEGER,
+                          writer TEXT NOT NULL,
+                          seq INTEGER NOT NULL,
+                          updated_at REAL NOT NULL,
+                          PRIMARY KEY (name, key))"""
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_seq (id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER NOT NULL)"
+            )
+            conn.execute("INSERT OR IGNORE INTO session_seq VALUES (1, 0)")
+            conn.execute("CREATE INDEX IF NOT EXISTS user_sessions_seq ON user_sessions (seq)")
+            conn.execute("CREATE INDEX IF NOT EXISTS conversations_seq ON conversations (seq)")
+            self._conn = conn
+        return self._conn
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def attach(self, application):
+        self.application = application
+
+    def _load_users(self):
+        conn = self._connection()
+        now = time.time()
+        self._seq = conn.execute("SELECT seq FROM session_seq").fetchone()[0]
+        rows = conn.execute(
+            "SELECT user_id, data, updated_at FROM user_sessions WHERE data IS NOT NULL AND updated_at > ?",
+            (now - self.ttl,)
+        ).fetchall()
+        for user_id, _, updated_at in rows:
+            self._touch(user_id, updated_at, now)
+        return {user_id: json.loads(data) for user_id, data, _ in rows}
+
+    def _load_conversations(self, name):
+        now = time.time()
+        rows = self._connection().execute(
+            """SELECT key, state, updated_at FROM conversations
+               WHERE name = ? AND state IS NOT NULL AND updated_at > ?""",
+            (name, now - self.ttl)
+        ).fetchall()
+        conversations = {}
+        for key, state, updated_at in rows:
+            key = tuple(json.loads(key))
+            self._touch(key[-1], updated_at, now)
+            conversations[key] = state
+        return conversations
+
+    def _touch(self, user_id, updated_at, now):
+        seen = time.monotonic() - (now - updated_at)
+        self._last_seen[user_id] = max(seen, self._last_seen.get(user_id, seen))
+
+    def _write(self, users, conversations):
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE session_seq SET seq = seq + 1")
+            seq = conn.execute("SELECT seq FROM session_seq").fetchone()[0]
+            conn.executemany(
+                "INSERT OR REPLACE INTO user_sessions VALUES (?, ?, ?, ?, ?)",
+                [(user_id, data, self.instance_id, seq, now) for user_id, data in users.items()]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (name, key, state, self.instance_id, seq, now)
+                    for (name, key), state in conversations.items()
+                ]
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _changes(self):
+        # Счетчик data_version меняется только от записей других соединений
+        conn = self._connection()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return None
+        self._data_version = version
+        conn.execute("BEGIN")
+        try:
+            seq = conn.execute("SELECT seq FROM session_seq").fetchone()[0]
+            users = conn.execute(
+                "SELECT user_id, data FROM user_sessions WHERE seq > ? AND seq <= ? AND writer != ?",
+                (self._seq, seq, self.instance_id)
+            ).fetchall()
+            conversations = conn.execute(
+                "SELECT name, key, state FROM conversations WHERE seq > ? AND seq <= ? AND writer != ?",
+                (self._seq, seq, self.instance_id)
+            ).fetchall()
+        finally:
+            conn.execute("COMMIT")
+        self._seq = seq
+        return users, conversations
+
+    def _load_session(self, user_id):
+        # Сессия пользователя, вытесненного из памяти этой реплики
+        conn = self._connection()
+        cutoff = time.time() - self.ttl
+        row = conn.execute(
+            "SELECT data FROM user_sessions WHERE user_id = ? AND updated_at > ?", (user_id, cutoff)
+        ).fetchone()
+        conversations = conn.execute(
+            """SELECT name, key, state FROM conversations
+               WHERE key LIKE ? AND state IS NOT NULL AND updated_at > ?""",
+            (f"%, {user_id}]", cutoff)
+        ).fetchall()
+        return row[0] if row else None, conversations
+
+    def _purge(self, max_age):
+        conn = self._connection()
+        cutoff = time.time() - max_age
+        with conn:
+            removed = conn.execute("DELETE FROM user_sessions WHERE updated_at < ?", (cutoff,)).rowcount
+            removed += conn.execute("DELETE FROM conversations WHERE updated_at < ?", (cutoff,)).rowcount
+        return removed
+
+    async def _schedule_write(self):
+        # Все вызовы одного прохода Application.update_persistence попадают
+        # в одну транзакцию
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_pending())
+        await asyncio.shield(self._write_task)
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        self._write_task = None
+        await self._call(self._write, users, conversations)
+
+    def _conversation_states(self):
+        # В PTB 20 нет публичного способа обновить состояние диалога после запуска
+        return self.application._conversation_handler_conversations if self.application else {}
+
+    def _apply_conversations(self, conversations):
+        states = self._conversation_states()
+        for name, key, state in conversations:
+            if name not in states:
+                continue
+            key = tuple(json.loads(key))
+            if state is None:
+                states[name].data.pop(key, None)
+            else:
+                states[name].update_no_track({key: state})
 
-# Инициализация базы данных
-init_db()
+    async def sync(self, update=None):
+        changes = await self._call(self._changes)
+        if changes is not None:
+            users, conversations = changes
+            # Активность на других репликах продлевает сессию и здесь
+            now = time.monotonic()
+            for user_id, data in users:
+                self._remote_users[user_id] = json.loads(data) if data is not None else None
+                self._last_seen[user_id] = now
+            for _, key, _ in conversations:
+                self._last_seen[json.loads(key)[-1]] = now
+            self._apply_conversations(conversations)
+        
+        # Вернувшийся пользователь снова получает сессию из базы
+        user = getattr(update, "effective_user", None)
+        if user is not None and user.id in self._evicted:
+            del self._evicted[user.id]
+            data, conversations = await self._call(self._load_session, user.id)
+            self._remote_users[user.id] = json.loads(data) if data is not None else None
+            self._apply_conversations(
+                [row for row in conversations if json.loads(row[1])[-1] == user.id]
+            )
+
+    def evict_idle(self):
+        # Сессии пользователей, неактивных дольше TTL, удаляются только из памяти:
+        # на другой реплике пользователь может быть активен, а из базы старые
+        # записи удаляет purge по общему updated_at
+        now = time.monotonic()
+        cutoff = now - self.ttl
+        # Через TTL после вытеснения без новой активности восстанавливать уже нечего
+        self._evicted = {
+            user_id: evicted for user_id, evicted in self._evicted.items()
+            if evicted > cutoff or user_id in self._last_seen
+        }
+        idle = {user_id for user_id, seen in self._last_seen.items() if seen < cutoff}
+        for user_id in idle:
+            del self._last_seen[user_id]
+            self.application._user_data.pop(user_id, None)
+            self.application._user_ids_to_be_updated_in_persistence.discard(user_id)
+        for states in self._conversation_states().values():
+            for key in [key for key in states if key[-1] in idle]:
+                states.data.pop(key, None)
+        self._evicted.update(dict.fromkeys(idle, now))
+        return len(idle)
+
+    async def purge(self, max_age=None):
+        return await self._call(self._purge, self.ttl if max_age is None else max_age)
+
+    async def get_user_data(self):
+        return await self._call(self._load_users)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return await self._call(self._load_conversations, name)
+
+    async def update_user_data(self, user_id, data):
+        self._pending_users[user_id] = json.dumps(data, ensure_ascii=False)
+        await self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._pending_users[user_id] = None
+        await self._schedule_write()
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, json.dumps(list(key)))] = new_state
+        await self._schedule_write()
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._last_seen[user_id] = time.monotonic()
+        if user_id in self._remote_users:
+            data = self._remote_users.pop(user_id)
+            user_data.clear()
+            if data:
+                user_data.update(data)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self._write_task is not None:
+            await asyncio.shield(self._write_task)
+        if self._pending_users or self._pending_conversations:
+            await self._write_pending()
+        self._executor.shutdown(wait=True)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
 
 # Сопоставление шаблонов
 TEMPLATES = {
@@ -49,83 +609,518 @@ TEMPLATES = {
     "imperative": "template_imperative.docx",
 }
 
-def replace_client_and_date(doc_path, client_name, date_str, template_key):
+# Реестр шаблонов: каждый .docx разбирается один раз, запросы получают копию
+TEMPLATES_DIR = "templates"
+
+# Подстановка на уровне zip: word/document.xml заранее разбивается на
+# статические байтовые сегменты и слоты, остальные части архива копируются
+# без изменений
+TEMPLATE_ENGINES = {
+    "ur_recruitment": "zip",
+}
+DOCUMENT_XML = "word/document.xml"
+WORD_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+SLOT_MARKERS = {"client": "{{pdfbot:client}}", "date": "{{pdfbot:date}}"}
+
+class ZipTemplate:
+    def __init__(self, content, template_key, client_index, date_indices):
+        with zipfile.ZipFile(io.BytesIO(content)) as source:
+            document_xml = source.read(DOCUMENT_XML)
+            for marker in SLOT_MARKERS.values():
+                if marker.encode("utf-8") in document_xml:
+                    raise ValueError(f"документ уже содержит {marker}")
+            
+            # Архив без document.xml собирается один раз
+            static_zip = io.BytesIO()
+            with zipfile.ZipFile(static_zip, "w") as target:
+                for info in source.infolist():
+                    if info.filename != DOCUMENT_XML:
+                        target.writestr(info, source.read(info.filename))
+        self.static_zip = static_zip.getvalue()
+        
+        root = etree.fromstring(document_xml)
+        paragraphs = root.find(f"{{{WORD_NS}}}body").findall(f"{{{WORD_NS}}}p")
+        if client_index is None:
+            raise ValueError("нет поля 'Client:'")
+        self._mark(paragraphs[client_index], ("Client:",), "client", clear_rest=template_key == "small_world")
+        for index in date_indices:
+            self._mark(paragraphs[index], ("Date:", "DATE:"), "date")
+        
+        xml = etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+        pattern = "|".join(re.escape(marker) for marker in SLOT_MARKERS.values())
+        parts = re.split(f"({pattern})".encode("utf-8"), xml)
+        slot_names = {marker.encode("utf-8"): name for name, marker in SLOT_MARKERS.items()}
+        self.segments = parts[0::2]
+        self.slots = [slot_names[marker] for marker in parts[1::2]]
+
+    @staticmethod
+    def _mark(paragraph, anchors, slot, clear_rest=False):
+        texts = list(paragraph.iter(f"{{{WORD_NS}}}t"))
+        marked = [t for t in texts if any(anchor in (t.text or "") for anchor in anchors)]
+        if not marked:
+            raise ValueError(f"якорь {anchors[0]} разбит между фрагментами текста")
+        for t in marked:
+            if clear_rest:
+                t.text = f"{anchors[0]} {SLOT_MARKERS[slot]}"
+            else:
+                for anchor in anchors:
+                    t.text = t.text.replace(anchor, f"{anchors[0]} {SLOT_MARKERS[slot]}")
+            t.set(XML_SPACE, "preserve")
+        if clear_rest:
+            for t in texts:
+                if t not in marked:
+                    t.text = ""
+
+    def bind(self, values):
+        # Частичная подстановка: заданные слоты вписываются в соседние
+        # сегменты, остальные остаются открытыми для render()
+        escaped = {name: xml_escape(value).encode("utf-8") for name, value in values.items()}
+        segments = [bytearray(self.segments[0])]
+        slots = []
+        for slot, segment in zip(self.slots, self.segments[1:]):
+            if slot in escaped:
+                segments[-1] += escaped[slot]
+                segments[-1] += segment
+            else:
+                slots.append(slot)
+                segments.append(bytearray(segment))
+        bound = copy.copy(self)
+        bound.segments = [bytes(segment) for segment in segments]
+        bound.slots = slots
+        return bound
+
+    def render(self, values):
+        escaped = {name: xml_escape(value).encode("utf-8") for name, value in values.items()}
+        document_xml = bytearray(self.segments[0])
+        for slot, segment in zip(self.slots, self.segments[1:]):
+            document_xml += escaped[slot]
+            document_xml += segment
+        
+        buffer = io.BytesIO()
+        buffer.write(self.static_zip)
+        with zipfile.ZipFile(buffer, "a", compression=zipfile.ZIP_DEFLATED) as target:
+            target.writestr(DOCUMENT_XML, bytes(document_xml))
+        buffer.seek(0)
+        return buffer
+
+class CompiledTemplate:
+    def __init__(self, key, path, mtime, content, document):
+        self.key = key
+        self.path = path
+        self.mtime = mtime
+        self.content = content
+        self.content_hash = hashlib.sha256(content).hexdigest()
+        self.document = document
+        
+        # Позиции якорей "Client:" и "Date:"/"DATE:" среди абзацев. Ищем по
+        # отдельной копии: обращение к paragraphs кэширует в Document тело
+        # документа, и последующие deepcopy теряют связь с ним
+        self.client_index = None
+        self.date_indices = []
+        for index, para in enumerate(docx.Document(io.BytesIO(content)).paragraphs):
+            if self.client_index is None and "Client:" in para.text:
+                self.client_index = index
+            if ("Date:" in para.text or "DATE:" in para.text) and len(self.date_indices) < 2:
+                self.date_indices.append(index)
+        if self.client_index is None:
+            logger.warning(f"Поле 'Client:' не найдено в {path}")
+        if len(self.date_indices) != 2:
+            logger.warning(f"Ожидалось 2 поля даты, найдено {len(self.date_indices)} в {path}")
+        
+        # Движок подстановки: zip, если шаблон для него размечен, иначе python-docx
+        self.engine = "docx"
+        self.zip_template = None
+        if TEMPLATE_ENGINES.get(key, "docx") == "zip":
+            try:
+                self.zip_template = ZipTemplate(content, key, self.client_index, self.date_indices)
+                self.engine = "zip"
+            except Exception as e:
+                logger.warning(f"Шаблон {path} не поддерживает zip-подстановку, используется python-docx: {e}")
+
+    def open_document(self):
+        return copy.deepcopy(self.document)
+
+class TemplateStore:
+    def __init__(self, templates, directory):
+        self.templates = templates
+        self.directory = directory
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def path(self, template_key):
+        return os.path.join(self.directory, self.templates[template_key])
+
+    def get(self, template_key):
+        path = self.path(template_key)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._compiled.pop(template_key, None)
+            raise FileNotFoundError(f"Шаблон {path} не найден")
+        
+        compiled = self._compiled.get(template_key)
+        if compiled is not None and compiled.mtime == mtime:
+            return compiled
+        with self._lock:
+            compiled = self._compiled.get(template_key)
+            if compiled is None or compiled.mtime != mtime:
+                with open(path, "rb") as f:
+                    content = f.read()
+                compiled = CompiledTemplate(
+                    template_key, path, mtime, content, docx.Document(io.BytesIO(content))
+                )
+                self._compiled[template_key] = compiled
+                logger.info(f"Шаблон {path} загружен")
+            return compiled
+
+    def load_all(self):
+        missing = []
+        for template_key in self.templates:
+            try:
+                self.get(template_key)
+            except Exception as e:
+                logger.error(f"Шаблон {template_key} недоступен: {e}")
+                missing.append(template_key)
+        return missing
+
+template_store = TemplateStore(TEMPLATES, TEMPLATES_DIR)
+
+def document_paragraphs(doc):
+    # Абзацы без кэширования тела в Document, чтобы deepcopy документа
+    # сохраняла внесенные правки (см. CompiledTemplate)
+    return [Paragraph(p, doc) for p in doc.element.body.p_lst]
+
+def apply_client(doc, template, client_name):
+    if template.client_index is not None:
+        para = document_paragraphs(doc)[template.client_index]
+        if template.key == "small_world":
+            # Очистка строки перед "Client:" для Small World
+            para.text = f"Client: {client_name}"
+        else:
+            para.text = para.text.replace("Client:", f"Client: {client_name}")
+
+def apply_date(doc, template, date_str):
+    # Замена Date (дважды на последней странице)
+    paragraphs = document_paragraphs(doc)
+    for index in template.date_indices:
+        para = paragraphs[index]
+        para.text = para.text.replace("Date:", f"Date: {date_str}")
+        para.text = para.text.replace("DATE:", f"Date: {date_str}")
+
+def replace_client_and_date(template_key, client_name, date_str):
     try:
-        if not os.path.exists(doc_path):
-            raise FileNotFoundError(f"Шаблон {doc_path} не найден")
-        
-        doc = docx.Document(doc_path)
-        
-        # Замена Client
-        client_replaced = False
-        for para in doc.paragraphs:
-            if "Client:" in para.text:
-                if template_key == "small_world":
-                    # Очистка строки перед "Client:" для Small World
-                    para.text = f"Client: {client_name}"
-                else:
-                    para.text = para.text.replace("Client:", f"Client: {client_name}")
-                client_replaced = True
-                break
-        if not client_replaced:
-            logger.warning(f"Поле 'Client:' не найдено в {doc_path}")
-        
-        # Замена Date (дважды на последней странице)
-        date_replaced_count = 0
-        last_page_paragraphs = []
-        current_page = []
-        
-        # Собираем абзацы, предполагая, что последняя страница — это последние абзацы
-        for para in doc.paragraphs:
-            current_page.append(para)
-        last_page_paragraphs = current_page
-        
-        # Ищем "Date:" или "DATE:" в последних абзацах и заменяем дважды
-        for para in last_page_paragraphs:
-            if ("Date:" in para.text or "DATE:" in para.text) and date_replaced_count < 2:
-                para.text = para.text.replace("Date:", f"Date: {date_str}")
-                para.text = para.text.replace("DATE:", f"Date: {date_str}")
-                date_replaced_count += 1
-        if date_replaced_count != 2:
-            logger.warning(f"Ожидалось 2 замены даты, выполнено {date_replaced_count} в {doc_path}")
-        
-        # Сохранение измененного документа
-        temp_path = f"temp_{uuid.uuid4()}.docx"
-        doc.save(temp_path)
-        logger.info(f"Создан временный файл: {temp_path}")
-        return temp_path
+        template = template_store.get(template_key)
+        doc = template.open_document()
+        apply_client(doc, template, client_name)
+        apply_date(doc, template, date_str)
+        
+        # Сохранение измененного документа в память
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        buffer.seek(0)
+        return buffer
     except Exception as e:
-        logger.error(f"Ошибка при обработке документа {doc_path}: {e}")
+        logger.error(f"Ошибка при обработке шаблона {template_key}: {e}")
         raise
 
-def convert_to_pdf(doc_path, client_name):
-    pdf_path = f"{client_name}.pdf"
+def substitute_document(template_key, client_name, date_str):
+    with observe_stage("substitution", template_key):
+        template = template_store.get(template_key)
+        if template.engine == "zip":
+            return template.zip_template.render({"client": client_name, "date": date_str})
+        return replace_client_and_date(template_key, client_name, date_str)
+
+# Рабочие каталоги задач: приватный каталог на задачу, по возможности в tmpfs,
+# удаляется при любом исходе; осиротевшие каталоги подбирает периодическая чистка
+SCRATCH_MAX_AGE = int(os.environ.get("SCRATCH_MAX_AGE", 2 * 60 * 60))
+SCRATCH_SWEEP_INTERVAL = int(os.environ.get("SCRATCH_SWEEP_INTERVAL", 15 * 60))
+SCRATCH_DISK_ROOT = os.environ.get(
+    "SCRATCH_DISK_ROOT", os.path.join(tempfile.gettempdir(), "pdfbot")
+)
+
+def _default_scratch_root():
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return os.path.join("/dev/shm", "pdfbot")
+    return SCRATCH_DISK_ROOT
+
+SCRATCH_ROOT = os.environ.get("SCRATCH_ROOT") or _default_scratch_root()
+
+@contextlib.contextmanager
+def job_scratch(prefix="job_", root=None):
+    root = root or SCRATCH_ROOT
+    os.makedirs(root, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=prefix, dir=root)
     try:
-        if not os.path.exists(doc_path):
-            raise FileNotFoundError(f"Временный файл {doc_path} не найден")
-        
-        # Вызов libreoffice для конвертации с ускорением
-        logger.info(f"Запуск конвертации {doc_path} в PDF")
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def sweep_scratch_dirs(max_age=SCRATCH_MAX_AGE):
+    removed = 0
+    cutoff = time.time() - max_age
+    for root in {SCRATCH_ROOT, SCRATCH_DISK_ROOT}:
+        if not os.path.isdir(root):
+            continue
+        for entry in os.scandir(root):
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    if removed:
+        logger.info(f"Удалено осиротевших рабочих файлов: {removed}")
+    return removed
+
+# Пул конвертеров LibreOffice
+LIBREOFFICE_BINARY = os.environ.get("LIBREOFFICE_BINARY", "libreoffice")
+CONVERTER_WORKERS = int(os.environ.get("CONVERTER_WORKERS", 2))
+CONVERTER_MAX_JOBS = int(os.environ.get("CONVERTER_MAX_JOBS", 200))
+CONVERTER_TIMEOUT = int(os.environ.get("CONVERTER_TIMEOUT", 60))
+CONVERTER_START_TIMEOUT = int(os.environ.get("CONVERTER_START_TIMEOUT", 60))
+CONVERTER_PROFILE_DIR = os.environ.get(
+    "CONVERTER_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "pdfbot_lo_profiles")
+)
+
+def _uno_property(name, value):
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+class ConverterWorker:
+    # Один тёплый экземпляр soffice со своим профилем. Если UNO недоступен,
+    # каждая задача запускает soffice разово, но с уже созданным профилем.
+    def __init__(self, index):
+        self.index = index
+        # Профиль привязан к процессу: LibreOffice допускает один запущенный
+        # экземпляр на профиль, а воркеров очереди на узле может быть несколько
+        self.profile_dir = os.path.join(CONVERTER_PROFILE_DIR, f"{os.getpid()}_worker_{index}")
+        self.pipe_name = f"pdfbot_soffice_{os.getpid()}_{index}"
+        self.process = None
+        self.desktop = None
+        self.jobs_done = 0
+
+    def _base_command(self):
+        return [
+            LIBREOFFICE_BINARY,
+            f"-env:UserInstallation={pathlib.Path(self.profile_dir).resolve().as_uri()}",
+            "--headless",
+            "--invisible",
+            "--nologo",
+            "--norestore",
+            "--nodefault",
+            "--nofirststartwizard",
+        ]
+
+    def alive(self):
+        if uno is None:
+            return True
+        return self.process is not None and self.process.poll() is None and self.desktop is not None
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self.jobs_done = 0
+        if uno is None:
+            return
+        logger.info(f"Запуск конвертера #{self.index}")
+        self.process = subprocess.Popen(
+            self._base_command() + [f"--accept=pipe,name={self.pipe_name};urp;StarOffice.ComponentContext"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context
+        )
+        deadline = time.monotonic() + CONVERTER_START_TIMEOUT
+        while True:
+            try:
+                context = resolver.resolve(
+                    f"uno:pipe,name={self.pipe_name};urp;StarOffice.ComponentContext"
+                )
+                break
+            except NoConnectException:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"Конвертер #{self.index} завершился при запуске")
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f"Конвертер #{self.index} не запустился за {CONVERTER_START_TIMEOUT} с")
+                time.sleep(0.25)
+        self.desktop = context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", context
+        )
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+    def stop(self):
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            self.desktop = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def convert(self, doc_path, pdf_path, timeout):
+        if uno is None:
+            self._convert_subprocess(doc_path, pdf_path, timeout)
+        else:
+            self._convert_uno(doc_path, pdf_path, timeout)
+        self.jobs_done += 1
+
+    def convert_many(self, doc_paths, outdir, timeout):
+        # Несколько файлов за один вызов soffice; PDF получают имена исходных файлов
+        if uno is None:
+            subprocess.run(
+                self._base_command() + ["--convert-to", "pdf", "--outdir", outdir, *doc_paths],
+                check=True,
+                timeout=timeout * len(doc_paths),
+            )
+        else:
+            for doc_path in doc_paths:
+                pdf_name = os.path.splitext(os.path.basename(doc_path))[0] + ".pdf"
+                self._convert_uno(doc_path, os.path.join(outdir, pdf_name), timeout)
+        self.jobs_done += len(doc_paths)
+
+    def _convert_uno(self, doc_path, pdf_path, timeout):
+        # Зависший soffice убивается по таймеру, UNO-вызов при этом падает
+        watchdog = threading.Timer(timeout, self.kill)
+        watchdog.start()
+        try:
+            document = self.desktop.loadComponentFromURL(
+                uno.systemPathToFileUrl(os.path.abspath(doc_path)),
+                "_blank",
+                0,
+                (_uno_property("Hidden", True),),
+            )
+            try:
+                document.storeToURL(
+                    uno.systemPathToFileUrl(os.path.abspath(pdf_path)),
+                    (_uno_property("FilterName", "writer_pdf_Export"),),
+                )
+            finally:
+                document.close(True)
+        except Exception:
+            if not watchdog.is_alive():
+                raise subprocess.TimeoutExpired(LIBREOFFICE_BINARY, timeout)
+            raise
+        finally:
+            watchdog.cancel()
+
+    def _convert_subprocess(self, doc_path, pdf_path, timeout):
+        outdir = os.path.dirname(pdf_path) or "."
         subprocess.run(
-            [
-                "libreoffice",
-                "--headless",
-                "--nofirststartwizard",  # Ускорение запуска LibreOffice
-                "--convert-to",
-                "pdf",
-                "--outdir",
-                os.path.dirname(doc_path) or ".",  # Убедимся, что outdir не пустой
-                doc_path
-            ],
+            self._base_command() + ["--convert-to", "pdf", "--outdir", outdir, doc_path],
             check=True,
-            timeout=60  # Увеличенный таймаут
+            timeout=timeout,
         )
-        # Переименование файла
-        temp_pdf = os.path.splitext(doc_path)[0] + ".pdf"
-        if not os.path.exists(temp_pdf):
-            raise FileNotFoundError(f"PDF-файл {temp_pdf} не создан")
+        produced = os.path.join(outdir, os.path.splitext(os.path.basename(doc_path))[0] + ".pdf")
+        if produced != pdf_path and os.path.exists(produced):
+            os.replace(produced, pdf_path)
+
+class ConverterPool:
+    def __init__(self, size, max_jobs, timeout):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _ensure_workers(self):
+        with self._lock:
+            if not self._workers:
+                self._workers = [ConverterWorker(i) for i in range(self.size)]
+                for worker in self._workers:
+                    self._idle.put(worker)
+
+    def _run(self, job):
+        self._ensure_workers()
+        worker = self._idle.get()
+        CONVERSIONS_IN_FLIGHT.inc()
+        try:
+            # Без UNO каждая задача и так запускает новый soffice: перезапускать нечего
+            if uno is not None and worker.jobs_done >= self.max_jobs:
+                logger.info(f"Перезапуск конвертера #{worker.index} после {worker.jobs_done} задач")
+                worker.stop()
+            if not worker.alive():
+                worker.stop()
+                worker.start()
+            job(worker)
+        except Exception:
+            # Упавший или зависший экземпляр будет перезапущен при следующей задаче
+            worker.kill()
+            worker.stop()
+            raise
+        finally:
+            CONVERSIONS_IN_FLIGHT.dec()
+            self._idle.put(worker)
+
+    def convert(self, doc_path, pdf_path):
+        self._run(lambda worker: worker.convert(doc_path, pdf_path, self.timeout))
+
+    def convert_many(self, doc_paths, outdir):
+        self._run(lambda worker: worker.convert_many(doc_paths, outdir, self.timeout))
+
+    def warm_up(self, doc_path, outdir, timeout):
+        # Каждый экземпляр один раз конвертирует пробный документ: создаются
+        # профиль LibreOffice и кэш шрифтов, загружаются фильтры экспорта
+        self._ensure_workers()
+        workers = [self._idle.get() for _ in range(self.size)]
+        try:
+            for worker in workers:
+                started = time.monotonic()
+                try:
+                    if not worker.alive():
+                        worker.stop()
+                        worker.start()
+                    worker.convert(doc_path, os.path.join(outdir, f"warmup_{worker.index}.pdf"), timeout)
+                except Exception:
+                    worker.kill()
+                    worker.stop()
+                    raise
+                logger.info(f"Конвертер #{worker.index} прогрет за {time.monotonic() - started:.1f} с")
+        finally:
+            for worker in workers:
+                self._idle.put(worker)
+
+    def close(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
+            shutil.rmtree(worker.profile_dir, ignore_errors=True)
+        self._idle = queue.Queue()
+
+converter_pool = ConverterPool(CONVERTER_WORKERS, CONVERTER_MAX_JOBS, CONVERTER_TIMEOUT)
+
+def convert_to_pdf(doc_path, client_name, template_key="-"):
+    # PDF создается рядом с документом, в рабочем каталоге задачи
+    pdf_path = os.path.splitext(doc_path)[0] + ".pdf"
+    try:
+        if not os.path.exists(doc_path):
+            raise FileNotFoundError(f"Временный файл {doc_path} не найден")
+        
+        # Конвертация через пул тёплых экземпляров LibreOffice
+        logger.info(f"Запуск конвертации {doc_path} в PDF для {client_name}")
+        with observe_stage("conversion", template_key):
+            converter_pool.convert(doc_path, pdf_path)
+        if not os.path.exists(pdf_path):
+            raise FileNotFoundError(f"PDF-файл {pdf_path} не создан")
         
-        os.rename(temp_pdf, pdf_path)
         logger.info(f"PDF создан: {pdf_path}")
         return pdf_path
     except subprocess.CalledProcessError as e:
@@ -141,7 +1136,1613 @@ def convert_to_pdf(doc_path, client_name):
         logger.error(f"Неизвестная ошибка при конвертации: {e}")
         raise
 
+# Постобработка PDF после конвертации. Ghostscript пересобирает файл с
+# подмножествами шрифтов, сжатием изображений и поиском дублей, pikepdf
+# удаляет неиспользуемые ресурсы, упаковывает объекты в потоки и при
+# необходимости линеаризует. Настройки по шаблонам задаются JSON в
+# PDF_POSTPROCESS, например {"ur_recruitment": {"ghostscript": "/ebook"}}.
+PDF_POSTPROCESS = os.environ.get("PDF_POSTPROCESS", "{}")
+GHOSTSCRIPT_BINARY = os.environ.get("GHOSTSCRIPT_BINARY", "gs")
+POSTPROCESS_TIMEOUT = int(os.environ.get("POSTPROCESS_TIMEOUT", 30))
+POSTPROCESS_DEFAULTS = {"ghostscript": None, "object_streams": True, "linearize": False}
+GHOSTSCRIPT_PRESETS = {"/screen", "/ebook", "/printer", "/prepress", "/default"}
+
+class PdfPostProcessor:
+    def __init__(self, config):
+        self.profiles = self._parse(config)
+        self._settings = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse(config):
+        # Ошибка в настройке выключает постобработку, но не мешает запуску бота
+        try:
+            profiles = json.loads(config)
+        except ValueError as e:
+            logger.error(f"PDF_POSTPROCESS не разобран, постобработка отключена: {e}")
+            return {}
+        if not isinstance(profiles, dict):
+            logger.error("PDF_POSTPROCESS должен быть объектом {шаблон: настройки}, постобработка отключена")
+            return {}
+        valid = {}
+        for template_key, profile in profiles.items():
+            if not isinstance(profile, dict):
+                logger.error(f"Настройки постобработки {template_key} должны быть объектом, шаблон пропущен")
+                continue
+            if template_key not in TEMPLATES:
+                logger.warning(f"Постобработка настроена для неизвестного шаблона {template_key}")
+            unknown = sorted(set(profile) - set(POSTPROCESS_DEFAULTS))
+            if unknown:
+                logger.warning(f"Неизвестные настройки постобработки {template_key}: {', '.join(unknown)}")
+            profile = {name: value for name, value in profile.items() if name in POSTPROCESS_DEFAULTS}
+            preset = profile.get("ghostscript")
+            if preset and preset not in GHOSTSCRIPT_PRESETS:
+                logger.warning(
+                    f"Неизвестный пресет Ghostscript {preset} для {template_key}, "
+                    f"допустимы {', '.join(sorted(GHOSTSCRIPT_PRESETS))}; Ghostscript отключен"
+                )
+                profile["ghostscript"] = None
+            valid[template_key] = profile
+        return valid
+
+    def settings(self, template_key):
+        # Итоговые настройки шаблона с учетом доступных инструментов; None — шаг выключен
+        if template_key in self._settings:
+            return self._settings[template_key]
+        with self._lock:
+            if template_key not in self._settings:
+                self._settings[template_key] = self._resolve(template_key)
+            return self._settings[template_key]
+
+    def _resolve(self, template_key):
+        profile = self.profiles.get(template_key)
+        if not profile:
+            return None
+        settings = {**POSTPROCESS_DEFAULTS, **profile}
+        if settings["ghostscript"] and shutil.which(GHOSTSCRIPT_BINARY) is None:
+            logger.warning(f"Ghostscript не найден, постобработка {template_key} без него")
+            settings["ghostscript"] = None
+        if pikepdf is None and (settings["object_streams"] or settings["linearize"]):
+            if not settings["ghostscript"]:
+                logger.warning(f"pikepdf не установлен, постобработка {template_key} отключена")
+                return None
+            logger.warning(f"pikepdf не установлен, для {template_key} работает только Ghostscript")
+        logger.info(f"Постобработка PDF для {template_key}: {settings}")
+        return settings
+
+    def process(self, pdf_data, template_key):
+        settings = self.settings(template_key)
+        if settings is None:
+            return pdf_data
+        try:
+            with observe_stage("postprocess", template_key):
+                data = pdf_data
+                if settings["ghostscript"]:
+                    data = self._ghostscript(data, settings)
+                if pikepdf is not None and (settings["object_streams"] or settings["linearize"]):
+                    data = self._repack(data, settings)
+        except Exception as e:
+            logger.warning(f"Постобработка PDF для {template_key} не удалась, используется исходный файл: {e}")
+            return pdf_data
+        
+        POSTPROCESS_RATIO.labels(template=template_key).observe(len(data) / max(len(pdf_data), 1))
+        if len(data) >= len(pdf_data):
+            return pdf_data
+        POSTPROCESS_SAVED_BYTES.labels(template=template_key).inc(len(pdf_data) - len(data))
+        return data
+
+    def process_file(self, pdf_path, template_key):
+        if self.settings(template_key) is None:
+            return
+        with open(pdf_path, "rb") as f:
+            pdf_data = f.read()
+        data = self.process(pdf_data, template_key)
+        if data is not pdf_data:
+            with open(pdf_path, "wb") as f:
+                f.write(data)
+
+    @staticmethod
+    def _ghostscript(pdf_data, settings):
+        with job_scratch(prefix="gs_") as scratch:
+            source = os.path.join(scratch, "source.pdf")
+            target = os.path.join(scratch, "target.pdf")
+            with open(source, "wb") as f:
+                f.write(pdf_data)
+            command = [
+                GHOSTSCRIPT_BINARY,
+                "-sDEVICE=pdfwrite",
+                "-dCompatibilityLevel=1.5",
+                f"-dPDFSETTINGS={settings['ghostscript']}",
+                "-dSubsetFonts=true",
+                "-dCompressFonts=true",
+                "-dDetectDuplicateImages=true",
+                "-dNOPAUSE",
+                "-dBATCH",
+                "-dQUIET",
+                "-dSAFER",
+                f"-sOutputFile={target}",
+                source,
+            ]
+            if settings["linearize"] and pikepdf is None:
+                command.insert(-2, "-dFastWebView=true")
+            subprocess.run(command, check=True, timeout=POSTPROCESS_TIMEOUT, capture_output=True)
+            with open(target, "rb") as f:
+                return f.read()
+
+    @staticmethod
+    def _repack(pdf_data, settings):
+        output = io.BytesIO()
+        with pikepdf.open(io.BytesIO(pdf_data)) as pdf:
+            pdf.remove_unreferenced_resources()
+            pdf.save(
+                output,
+                compress_streams=True,
+                object_stream_mode=(
+                    pikepdf.ObjectStreamMode.generate if settings["object_streams"]
+                    else pikepdf.ObjectStreamMode.preserve
+                ),
+                linearize=settings["linearize"],
+            )
+        return output.getvalue()
+
+pdf_postprocessor = PdfPostProcessor(PDF_POSTPROCESS)
+
+# Штамповка значений поверх заранее отрендеренного PDF шаблона без LibreOffice
+# Включается явно для шаблонов, например STAMP_TEMPLATES=ur_recruitment
+STAMP_TEMPLATES = {key for key in os.environ.get("STAMP_TEMPLATES", "").split(",") if key}
+# Начертание поля берется из шрифта якоря в PDF: "Client:" в заголовке набран жирным
+STAMP_FONTS = {
+    "regular": (
+        "StampFont",
+        os.environ.get("STAMP_FONT_PATH", "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf"),
+    ),
+    "bold": (
+        "StampFontBold",
+        os.environ.get("STAMP_BOLD_FONT_PATH", "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf"),
+    ),
+}
+STAMP_COLOR = "#454545"
+
+class StampLayout:
+    def __init__(self, content_hash, base_pdf, fields, values=None):
+        self.content_hash = content_hash
+        self.base_pdf = base_pdf
+        # (номер страницы, x, y, размер шрифта, горизонтальный масштаб, слот, шрифт)
+        self.fields = fields
+        # Значения, запомненные без штамповки: печатаются вместе с остальными
+        self.values = values or {}
+
+class StampRegistry:
+    def __init__(self, template_keys):
+        self.template_keys = template_keys
+        self._layouts = {}
+        self._failed = {}
+        self._fonts = {}
+        self._lock = threading.Lock()
+
+    def _font(self, weight):
+        # Имя зарегистрированного в reportlab шрифта или None, если файла нет
+        if weight not in self._fonts:
+            name, path = STAMP_FONTS[weight]
+            try:
+                pdfmetrics.registerFont(TTFont(name, path))
+                self._fonts[weight] = name
+            except Exception as e:
+                logger.warning(f"Шрифт для штамповки {path} недоступен: {e}")
+                self._fonts[weight] = None
+        return self._fonts[weight]
+
+    @staticmethod
+    def _weight(font_dict):
+        base_font = str(font_dict.get("/BaseFont", "")) if font_dict is not None else ""
+        return "bold" if "bold" in base_font.lower() else "regular"
+
+    def _stampable(self, template):
+        if PdfReader is None or template.key not in self.template_keys or template.key == "small_world":
+            return False
+        # Значение дописывается сразу после якоря, поэтому после него в строке не должно быть текста
+        paragraphs = docx.Document(io.BytesIO(template.content)).paragraphs
+        if template.client_index is None or len(template.date_indices) != 2:
+            return False
+        if not paragraphs[template.client_index].text.rstrip().endswith("Client:"):
+            return False
+        # "DATE:" при подстановке меняется на "Date:", штампом этого не сделать
+        return all(
+            paragraphs[index].text.rstrip().endswith("Date:")
+            for index in template.date_indices
+        )
+
+    def ready(self, template):
+        layout = self._layouts.get(template.key)
+        return layout is not None and layout.content_hash == template.content_hash
+
+    def layout(self, template):
+        if self.ready(template):
+            return self._layouts[template.key]
+        if self._failed.get(template.key) == template.content_hash:
+            return None
+        with self._lock:
+            if self.ready(template):
+                return self._layouts[template.key]
+            try:
+                layout = self._calibrate(template)
+            except Exception as e:
+                logger.warning(f"Калибровка штамповки для {template.key} не удалась: {e}")
+                layout = None
+            if layout is None:
+                self._failed[template.key] = template.content_hash
+                self._layouts.pop(template.key, None)
+                return None
+            self._layouts[template.key] = layout
+            self._failed.pop(template.key, None)
+            return layout
+
+    def _calibrate(self, template):
+        if not self._stampable(template):
+            return None
+        
+        # Однократный рендер шаблона без подстановок
+        with job_scratch(prefix="stamp_") as scratch:
+            doc_path = os.path.join(scratch, f"{template.key}.docx")
+            pdf_path = os.path.join(scratch, f"{template.key}.pdf")
+            with open(doc_path, "wb") as f:
+                f.write(template.content)
+            converter_pool.convert(doc_path, pdf_path)
+            with open(pdf_path, "rb") as f:
+                base_pdf = f.read()
+        
+        # Поиск координат якорей в тексте PDF
+        fields = []
+        missing_fonts = set()
+        reader = PdfReader(io.BytesIO(base_pdf))
+        for page_index, page in enumerate(reader.pages):
+            def visitor(text, cm, tm, font_dict, font_size):
+                for anchor, slot in (("Client:", "client"), ("Date:", "date")):
+                    if anchor not in text:
+                        continue
+                    if slot == "client" and any(field[5] == "client" for field in fields):
+                        continue
+                    x = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+                    y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+                    scale_x = tm[0] * cm[0] + tm[1] * cm[2]
+                    scale_y = tm[2] * cm[1] + tm[3] * cm[3]
+                    size = font_size * scale_y
+                    horizontal_scale = scale_x / scale_y if scale_y else 1.0
+                    # Смещение меряется тем же начертанием, которым значение будет напечатано
+                    weight = self._weight(font_dict)
+                    font_name = self._font(weight)
+                    if font_name is None:
+                        missing_fonts.add(weight)
+                        continue
+                    prefix = text[: text.index(anchor)] + ("Client: " if slot == "client" else "Date: ")
+                    offset = pdfmetrics.stringWidth(prefix, font_name, size) * horizontal_scale
+                    fields.append((page_index, x + offset, y, size, horizontal_scale, slot, font_name))
+            page.extract_text(visitor_text=visitor)
+        
+        if missing_fonts:
+            logger.warning(f"Нет шрифтов {', '.join(sorted(missing_fonts))} для {template.key}, штамповка отключена")
+            return None
+        slots = [field[5] for field in fields]
+        if slots.count("client") != 1 or slots.count("date") != 2:
+            logger.warning(f"В PDF шаблона {template.key} найдены поля {slots}, штамповка отключена")
+            return None
+        logger.info(f"Шаблон {template.key} откалиброван для штамповки: {fields}")
+        # Штампы ложатся на уже обработанный PDF: постобработка выполняется один раз
+        base_pdf = pdf_postprocessor.process(base_pdf, template.key)
+        return StampLayout(template.content_hash, base_pdf, fields)
+
+    def bind(self, layout, values):
+        # Штамповка части полей: получается раскладка с уже проставленными
+        # значениями в базовом PDF и оставшимися полями
+        output = io.BytesIO()
+        stamped = [field for field in layout.fields if field[5] in values]
+        self.stamp(StampLayout(layout.content_hash, layout.base_pdf, stamped), values, output)
+        remaining = [field for field in layout.fields if field[5] not in values]
+        return StampLayout(layout.content_hash, output.getvalue(), remaining, layout.values)
+
+    @staticmethod
+    def defer(layout, values):
+        # Раскладка с запомненными значениями: базовый PDF общий, а штамповка
+        # откладывается до stamp(), где занимает миллисекунды
+        return StampLayout(layout.content_hash, layout.base_pdf, layout.fields, {**layout.values, **values})
+
+    def stamp(self, layout, values, output):
+        values = {**layout.values, **values}
+        writer = PdfWriter(clone_from=io.BytesIO(layout.base_pdf))
+        for page_index in sorted({field[0] for field in layout.fields}):
+            page = writer.pages[page_index]
+            overlay = io.BytesIO()
+            c = pdf_canvas.Canvas(
+                overlay, pagesize=(float(page.mediabox.width), float(page.mediabox.height))
+            )
+            c.setFillColor(STAMP_COLOR)
+            for field_page, x, y, size, horizontal_scale, slot, font_name in layout.fields:
+                if field_page != page_index:
+                    continue
+                text = c.beginText(x, y)
+                text.setFont(font_name, size)
+                text.setHorizScale(horizontal_scale * 100)
+                text.textOut(values[slot])
+                c.drawText(text)
+            c.save()
+            overlay.seek(0)
+            page.merge_page(PdfReader(overlay).pages[0])
+        writer.write(output)
+        return output
+
+stamp_registry = StampRegistry(STAMP_TEMPLATES)
+
+def render_variant(template):
+    return "stamp" if stamp_registry.ready(template) else template.engine
+
+# Очередь генерации документов
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", CONVERTER_WORKERS))
+GENERATION_QUEUE_SIZE = int(os.environ.get("GENERATION_QUEUE_SIZE", 20))
+WAIT_MESSAGE = "Ожидайте, ваш документ генерируется..."
+QUEUE_FULL_MESSAGE = "Сейчас слишком много запросов на генерацию. Попробуйте снова через минуту."
+
+class GenerationQueueFull(Exception):
+    pass
+
+class GenerationExecutor:
+    # Не более max_workers генераций одновременно, остальные ждут в очереди
+    # ограниченной длины в порядке поступления
+    def __init__(self, max_workers, max_queue):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generation")
+        self._waiting = []
+        self._running = 0
+        self._changed = None
+        self._releases = set()
+
+    @property
+    def queue_depth(self):
+        return len(self._waiting)
+
+    @property
+    def in_flight(self):
+        return self._running
+
+    async def _acquire(self, ticket, progress):
+        reported = None
+        while True:
+            async with self._changed:
+                while True:
+                    position = self._waiting.index(ticket)
+                    if position == 0 and self._running < self.max_workers:
+                        self._waiting.remove(ticket)
+                        self._running += 1
+                        self._changed.notify_all()
+                        return
+                    if position != reported:
+                        break
+                    await self._changed.wait()
+            reported = position
+            if progress is not None:
+                await progress(position + 1)
+
+    async def _release(self):
+        async with self._changed:
+            self._running -= 1
+            self._changed.notify_all()
+
+    def _release_when_done(self, loop, future):
+        # Отмененный вызов не прерывает поток: слот занят, пока он не закончит,
+        # иначе следующая задача считалась бы выполняемой, ожидая в пуле
+        def schedule():
+            task = loop.create_task(self._release())
+            self._releases.add(task)
+            task.add_done_callback(self._releases.discard)
+        
+        def done(_):
+            try:
+                loop.call_soon_threadsafe(schedule)
+            except RuntimeError:
+                # Цикл событий уже закрыт при остановке
+                pass
+        
+        future.add_done_callback(done)
+
+    async def run(self, func, *args, progress=None):
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        if len(self._waiting) >= self.max_queue:
+            raise GenerationQueueFull()
+        ticket = object()
+        self._waiting.append(ticket)
+        try:
+            await self._acquire(ticket, progress)
+        except BaseException:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                async with self._changed:
+                    self._changed.notify_all()
+            raise
+        # Контекст копируется, чтобы идентификатор задачи попадал в логи потоков
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        future = self._pool.submit(context.run, func, *args)
+        try:
+            result = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if not future.cancel():
+                self._release_when_done(loop, future)
+                raise
+            await self._release()
+            raise
+        except BaseException:
+            await self._release()
+            raise
+        await self._release()
+        return result
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+generation_executor = GenerationExecutor(GENERATION_WORKERS, GENERATION_QUEUE_SIZE)
+QUEUE_DEPTH.set_function(lambda: generation_executor.queue_depth)
+GENERATIONS_IN_FLIGHT.set_function(lambda: generation_executor.in_flight)
+
+# Промежуточные результаты рендера по сессиям: клиент уже подставлен, слоты
+# даты открыты, и смена даты дорендеривает только их
+SESSION_ARTIFACT_TTL = int(os.environ.get("SESSION_ARTIFACT_TTL", 30 * 60))
+SESSION_ARTIFACT_MAX_BYTES = int(os.environ.get("SESSION_ARTIFACT_MAX_BYTES", 64 * 1024 * 1024))
+
+def artifact_size(template, variant, artifact):
+    # Оценка памяти заготовки без частей, общих с шаблоном
+    if variant == "stamp":
+        return sum(len(value.encode("utf-8")) for value in artifact.values.values()) + 256
+    if variant == "zip":
+        return sum(len(segment) for segment in artifact.segments)
+    # Копия документа python-docx держит все части пакета, включая изображения
+    return len(template.content)
+
+class SessionArtifacts:
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # сессия -> (хэш шаблона, ключ шаблона, клиент, способ рендера, заготовка, время, размер)
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, session, template, client_name):
+        with self._lock:
+            entry = self._entries.get(session)
+            if entry is None or entry[:3] != (template.content_hash, template.key, client_name):
+                return None
+            self._entries[session] = entry[:5] + (time.monotonic(), entry[6])
+            self._entries.move_to_end(session)
+            return entry[3], entry[4]
+
+    def _pop(self, session):
+        entry = self._entries.pop(session, None)
+        if entry is not None:
+            self._total_bytes -= entry[6]
+
+    def put(self, session, template, client_name, variant, artifact):
+        size = artifact_size(template, variant, artifact)
+        with self._lock:
+            self._pop(session)
+            if size > self.max_bytes:
+                return
+            self._entries[session] = (
+                template.content_hash, template.key, client_name, variant, artifact, time.monotonic(), size
+            )
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def discard(self, session):
+        with self._lock:
+            self._pop(session)
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            idle = [session for session, entry in self._entries.items() if entry[5] < cutoff]
+            for session in idle:
+                self._pop(session)
+        return len(idle)
+
+session_artifacts = SessionArtifacts(SESSION_ARTIFACT_TTL, SESSION_ARTIFACT_MAX_BYTES)
+
+def bind_client(template, client_name):
+    layout = stamp_registry.layout(template)
+    if layout is not None:
+        # Для штамповки хранится только ссылка на раскладку и имя клиента
+        return "stamp", stamp_registry.defer(layout, {"client": client_name})
+    with observe_stage("substitution", template.key):
+        if template.engine == "zip":
+            return "zip", template.zip_template.bind({"client": client_name})
+        doc = template.open_document()
+        apply_client(doc, template, client_name)
+        return "docx", doc
+
+def prepare_bound(template, variant, artifact, values, client_name):
+    # Дорендер заготовки: подставляются только оставшиеся значения
+    if variant == "stamp":
+        output = io.BytesIO()
+        with observe_stage("stamp", template.key):
+            stamp_registry.stamp(artifact, values, output)
+        logger.info(f"PDF создан штамповкой для {client_name}")
+        return output.getvalue(), variant
+    
+    with observe_stage("substitution", template.key):
+        if variant == "zip":
+            buffer = artifact.render(values)
+        else:
+            doc = copy.deepcopy(artifact)
+            if "client" in values:
+                apply_client(doc, template, values["client"])
+            if "date" in values:
+                apply_date(doc, template, values["date"])
+            buffer = io.BytesIO()
+            doc.save(buffer)
+    return buffer, variant
+
+def prepare_session_document(template, client_name, date_str, session):
+    bound = session_artifacts.get(session, template, client_name)
+    if bound is not None:
+        logger.info(f"Повторный рендер с новой датой по заготовке сессии для {client_name}")
+        return prepare_bound(template, *bound, {"date": date_str}, client_name)
+    
+    # Документ на сегодня собирается из дневной заготовки; заготовка сессии
+    # понадобится только при смене даты
+    snapshot = date_snapshots.get(template, date_str)
+    if snapshot is not None:
+        return prepare_bound(template, *snapshot, {"client": client_name}, client_name)
+    
+    bound = bind_client(template, client_name)
+    session_artifacts.put(session, template, client_name, *bound)
+    return prepare_bound(template, *bound, {"date": date_str}, client_name)
+
+def convert_document(buffer, template_key, client_name):
+    with job_scratch() as scratch:
+        doc_path = os.path.join(scratch, "document.docx")
+        with open(doc_path, "wb") as f:
+            f.write(buffer.getbuffer())
+        pdf_path = convert_to_pdf(doc_path, client_name, template_key)
+        with open(pdf_path, "rb") as f:
+            return pdf_postprocessor.process(f.read(), template_key)
+
+# Дневные заготовки шаблонов: сегодняшняя дата по Киеву уже подставлена в оба
+# поля на последней странице, запросам текущего дня остается подставить клиента.
+# Пересобираются в полночь по Киеву и при изменении шаблона.
+KYIV_TZ = ZoneInfo("Europe/Kiev")
+
+def kyiv_today():
+    return datetime.now(KYIV_TZ).strftime("%Y-%m-%d")
+
+class DateSnapshots:
+    def __init__(self):
+        # ключ шаблона -> (хэш шаблона, дата, способ рендера, заготовка)
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _build(template, date_str):
+        with observe_stage("snapshot", template.key):
+            layout = stamp_registry.layout(template)
+            if layout is not None:
+                return "stamp", stamp_registry.bind(layout, {"date": date_str})
+            if template.engine == "zip":
+                return "zip", template.zip_template.bind({"date": date_str})
+            doc = template.open_document()
+            apply_date(doc, template, date_str)
+            return "docx", doc
+
+    def refresh(self, template_keys, date_str):
+        # Заготовки прошедших дней отбрасываются целиком
+        snapshots = {}
+        for template_key in template_keys:
+            try:
+                template = template_store.get(template_key)
+            except FileNotFoundError:
+                continue
+            try:
+                snapshots[template_key] = (template.content_hash, date_str, *self._build(template, date_str))
+            except Exception as e:
+                logger.warning(f"Не удалось собрать заготовку {template_key} на {date_str}: {e}")
+        with self._lock:
+            self._snapshots = snapshots
+        logger.info(f"Заготовки на {date_str} собраны: {', '.join(snapshots) or 'нет'}")
+        return len(snapshots)
+
+    def get(self, template, date_str):
+        if date_str != kyiv_today():
+            return None
+        with self._lock:
+            snapshot = self._snapshots.get(template.key)
+        if snapshot is not None and snapshot[:3] == (template.content_hash, date_str, render_variant(template)):
+            return snapshot[2], snapshot[3]
+        
+        # Шаблон изменился или задача в полночь еще не отработала
+        variant, artifact = self._build(template, date_str)
+        with self._lock:
+            self._snapshots[template.key] = (template.content_hash, date_str, variant, artifact)
+        return variant, artifact
+
+date_snapshots = DateSnapshots()
+
+def prepare_document(template_key, client_name, date_str, session=None):
+    # Всё до конвертации: для штамповки сразу готовый PDF, иначе DOCX в памяти
+    template = template_store.get(template_key)
+    if session is not None:
+        return prepare_session_document(template, client_name, date_str, session)
+    snapshot = date_snapshots.get(template, date_str)
+    if snapshot is not None:
+        return prepare_bound(template, *snapshot, {"client": client_name}, client_name)
+    
+    # Быстрый путь: штамповка по откалиброванному шаблону прямо в память
+    layout = stamp_registry.layout(template)
+    if layout is not None:
+        output = io.BytesIO()
+        with observe_stage("stamp", template_key):
+            stamp_registry.stamp(layout, {"client": client_name, "date": date_str}, output)
+        logger.info(f"PDF создан штамповкой для {client_name}")
+        return output.getvalue(), "stamp"
+    
+    return substitute_document(template_key, client_name, date_str), template.engine
+
+def render_document(template_key, client_name, date_str, session=None):
+    data, variant = prepare_document(template_key, client_name, date_str, session)
+    if variant == "stamp":
+        return data, variant
+    return convert_document(data, template_key, client_name), variant
+
+# Кэш готовых PDF: ключ — хэш содержимого шаблона и подставленных значений
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join("cache", "results"))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+
+class ResultCache:
+    # PDF хранятся на диске с вытеснением давно не использованных записей
+    # по суммарному размеру; рядом сохраняется file_id из Telegram
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._file_ids = {}
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(template, variant, client_name, date_str):
+        # Смена настроек постобработки дает другие PDF и другой ключ
+        postprocess = json.dumps(pdf_postprocessor.settings(template.key), sort_keys=True)
+        raw = "\0".join([template.content_hash, template.key, variant, client_name, date_str, postprocess])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _pdf_path(self, key):
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def _file_id_path(self, key):
+        return os.path.join(self.directory, f"{key}.file_id")
+
+    def _load(self):
+        if self._loaded:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pdf"):
+                continue
+            key = name[:-4]
+            stat = os.stat(self._pdf_path(key))
+            entries.append((stat.st_mtime, key, stat.st_size))
+            try:
+                with open(self._file_id_path(key), encoding="utf-8") as f:
+                    self._file_ids[key] = f.read().strip()
+            except FileNotFoundError:
+                pass
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._loaded = True
+        logger.info(f"Кэш PDF: {len(self._entries)} файлов, {self._total_bytes} байт")
+
+    def _remove(self, key):
+        self._total_bytes -= self._entries.pop(key, 0)
+        self._file_ids.pop(key, None)
+        for path in (self._pdf_path(key), self._file_id_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def file_id(self, key):
+        with self._lock:
+            self._load()
+            if key in self._entries:
+                # Порядок вытеснения после перезапуска восстанавливается по mtime
+                self._entries.move_to_end(key)
+                try:
+                    os.utime(self._pdf_path(key))
+                except FileNotFoundError:
+                    self._remove(key)
+            return self._file_ids.get(key)
+
+    def set_file_id(self, key, file_id):
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._file_ids[key] = file_id
+            with open(self._file_id_path(key), "w", encoding="utf-8") as f:
+                f.write(file_id)
+
+    def forget_file_id(self, key):
+        with self._lock:
+            self._file_ids.pop(key, None)
+            try:
+                os.remove(self._file_id_path(key))
+            except FileNotFoundError:
+                pass
+
+    def read(self, key):
+        with self._lock:
+            self._load()
+            if key not in self._entries:
+                return None
+            try:
+                with open(self._pdf_path(key), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            os.utime(self._pdf_path(key))
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._load()
+            self._remove(key)
+            partial_path = f"{self._pdf_path(key)}.{uuid.uuid4().hex}.part"
+            with open(partial_path, "wb") as f:
+                f.write(data)
+            os.replace(partial_path, self._pdf_path(key))
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                logger.info(f"Вытеснение из кэша PDF: {oldest}")
+                self._remove(oldest)
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+
+# Выполняющиеся генерации: одинаковые запросы одного пользователя получают общий
+# результат. Внутри чата обновления идут по очереди, так что склеиваются запросы
+# из разных чатов пользователя и повторы, пришедшие во время фоновой конвертации.
+inflight_generations = {}
+
+async def join_generation(pending):
+    # Отмена первого запроса (например, /cancel) не должна обрывать
+    # присоединившихся: вместо результата они получают None и генерируют сами
+    try:
+        return await asyncio.shield(pending)
+    except asyncio.CancelledError:
+        if pending.cancelled() and not asyncio.current_task().cancelling():
+            return None
+        raise
+
+async def send_generated_document(message, user_id, template_key, client_name, date_str):
+    outcome = "error"
+    try:
+        if GENERATION_MODE == "queue":
+            outcome = await enqueue_generation(message, template_key, client_name, date_str)
+            return outcome
+        
+        template = template_store.get(template_key)
+        cache_key = ResultCache.key(template, render_variant(template), client_name, date_str)
+        
+        # Повторная отправка уже загруженного в Telegram PDF без конвертации
+        file_id = await asyncio.to_thread(result_cache.file_id, cache_key)
+        if file_id is not None:
+            try:
+                with observe_stage("upload", template_key):
+                    await message.reply_document(document=file_id)
+                logger.info(f"PDF отправлен из кэша по file_id: {cache_key}")
+                outcome = "file_id"
+                return outcome
+            except telegram.error.TelegramError as e:
+                logger.warning(f"file_id из кэша недействителен: {e}")
+                await asyncio.to_thread(result_cache.forget_file_id, cache_key)
+        
+        outcome_if_sent = "cache"
+        pdf_data = await asyncio.to_thread(result_cache.read, cache_key)
+        inflight_key = (user_id, template_key, client_name, date_str)
+        pending = inflight_generations.get(inflight_key)
+        if pdf_data is None and pending is not None:
+            # Такой же запрос уже генерируется: ждём его результат
+            logger.info(f"Запрос присоединен к выполняющейся генерации для {client_name}")
+            joined = await join_generation(pending)
+            if joined is not None:
+                pdf_data, cache_key = joined
+                outcome_if_sent = "deduplicated"
+            else:
+                logger.info(f"Общая генерация для {client_name} отменена, запрос выполняется отдельно")
+        if pdf_data is None and outcome_if_sent != "deduplicated":
+            if generation_executor.queue_depth >= generation_executor.max_queue:
+                raise GenerationQueueFull()
+            
+            # Сообщение о начале генерации, дополняется позицией в очереди
+            status_message = await message.reply_text(WAIT_MESSAGE)
+            
+            async def report_position(position):
+                try:
+                    await status_message.edit_text(f"{WAIT_MESSAGE}\nВы #{position} в очереди.")
+                except telegram.error.TelegramError as e:
+                    logger.warning(f"Не удалось обновить позицию в очереди: {e}")
+            
+            if DELIVERY_MODE == "progressive" and render_variant(template) != "stamp":
+                outcome = await send_progressive_document(
+                    message, status_message, inflight_key, template, client_name, date_str,
+                    progress=report_position,
+                )
+                return outcome
+            
+            pending = asyncio.get_running_loop().create_future()
+            inflight_generations[inflight_key] = pending
+            try:
+                pdf_data, variant = await generation_executor.run(
+                    render_document, template_key, client_name, date_str, message.chat_id,
+                    progress=report_position,
+                )
+                
+                # PDF сохраняется в кэш под ключом фактически использованного способа рендера
+                cache_key = ResultCache.key(template, variant, client_name, date_str)
+                await asyncio.to_thread(result_cache.put, cache_key, pdf_data)
+                pending.set_result((pdf_data, cache_key))
+            except asyncio.CancelledError:
+                pending.cancel()
+                raise
+            except Exception as e:
+                pending.set_exception(e)
+                # Отмечаем исключение полученным: ожидающих может и не быть
+                pending.exception()
+                raise
+            finally:
+                inflight_generations.pop(inflight_key, None)
+            outcome_if_sent = variant
+        
+        # Отправка PDF из памяти под отображаемым именем
+        with observe_stage("upload", template_key):
+            sent_message = await message.reply_document(document=pdf_data, filename=f"{client_name}.pdf")
+        if sent_message.document is not None:
+            await asyncio.to_thread(result_cache.set_file_id, cache_key, sent_message.document.file_id)
+        outcome = outcome_if_sent
+    except GenerationQueueFull:
+        outcome = "rejected"
+        raise
+    finally:
+        GENERATIONS.labels(template=template_key, outcome=outcome).inc()
+    return outcome
+
+# Долговременная очередь генерации: в режиме GENERATION_MODE=queue обработчики
+# только записывают задачу в SQLite, а рендер и отправку выполняют отдельные
+# процессы `python main.py worker`, забирающие задачи с арендой
+GENERATION_MODE = os.environ.get("GENERATION_MODE", "inline")
+JOB_QUEUE_DB = os.environ.get("JOB_QUEUE_DB", "jobs.db")
+JOB_QUEUE_MAX_PENDING = int(os.environ.get("JOB_QUEUE_MAX_PENDING", 500))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 3 * CONVERTER_TIMEOUT))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_DELAY = int(os.environ.get("JOB_RETRY_DELAY", 10))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1))
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", 24 * 60 * 60))
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", CONVERTER_WORKERS))
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", 0))
+JOB_FAILED_MESSAGE = "Не удалось сгенерировать документ. Попробуйте позже."
+# Ошибки, при которых повтор задачи бессмысленен
+JOB_PERMANENT_ERRORS = (FileNotFoundError, telegram.error.Forbidden, telegram.error.BadRequest)
+
+class QueuedJob:
+    def __init__(self, job_id, chat_id, template_key, client_name, date, attempts):
+        self.id = job_id
+        self.chat_id = chat_id
+        self.template_key = template_key
+        self.client_name = client_name
+        self.date = date
+        self.attempts = attempts
+
+class JobQueue:
+    # Файл базы может лежать на общем томе нескольких узлов, поэтому журнал
+    # обычный: WAL требует общей памяти процессов одного узла
+    def __init__(self, path, max_pending, lease_seconds):
+        self.path = path
+        self.max_pending = max_pending
+        self.lease_seconds = lease_seconds
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs")
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs
+                         (id INTEGER PRIMARY KEY,
+                          chat_id INTEGER NOT NULL,
+                          template_key TEXT NOT NULL,
+                          client_name TEXT NOT NULL,
+                          date TEXT NOT NULL,
+                          status TEXT NOT NULL,
+                          attempts INTEGER NOT NULL DEFAULT 0,
+                          available_at REAL NOT NULL,
+                          lease_owner TEXT,
+                          lease_until REAL,
+                          last_error TEXT,
+                          created_at REAL NOT NULL,
+                          updated_at REAL NOT NULL)"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at)")
+            self._conn = conn
+        return self._conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE сразу берет блокировку записи: два процесса
+        # не смогут забрать одну и ту же задачу
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _enqueue(self, chat_id, template_key, client_name, date):
+        now = time.time()
+        with self._transaction() as conn:
+            # Повторный запрос того же документа присоединяется к ожидающей задаче
+            row = conn.execute(
+                """SELECT id FROM jobs WHERE chat_id = ? AND template_key = ? AND client_name = ?
+                   AND date = ? AND status IN ('queued', 'running')""",
+                (chat_id, template_key, client_name, date)
+            ).fetchone()
+            if row is not None:
+                return row[0], None
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchone()[0]
+            if pending >= self.max_pending:
+                raise GenerationQueueFull()
+            job_id = conn.execute(
+                """INSERT INTO jobs (chat_id, template_key, client_name, date, status,
+                                     available_at, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)""",
+                (chat_id, template_key, client_name, date, now, now, now)
+            ).lastrowid
+            position = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND id <= ?", (job_id,)
+            ).fetchone()[0]
+        return job_id, position
+
+    def _claim(self, owner):
+        # Свободная задача или задача, аренда которой истекла (процесс упал)
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                """SELECT id, chat_id, template_key, client_name, date, attempts FROM jobs
+                   WHERE (status = 'queued' AND available_at <= ?)
+                      OR (status = 'running' AND lease_until < ?)
+                   ORDER BY id LIMIT 1""",
+                (now, now)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                """UPDATE jobs SET status = 'running', lease_owner = ?, lease_until = ?,
+                                   attempts = attempts + 1, updated_at = ?
+                   WHERE id = ?""",
+                (owner, now + self.lease_seconds, now, row[0])
+            )
+        return QueuedJob(row[0], row[1], row[2], row[3], row[4], row[5] + 1)
+
+    def _update_leased(self, job_id, owner, assignments, params):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"""UPDATE jobs SET {assignments}, updated_at = ?
+                    WHERE id = ? AND lease_owner = ? AND status = 'running'""",
+                (*params, time.time(), job_id, owner)
+            )
+        return cursor.rowcount > 0
+
+    def _prune(self, max_age):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (time.time() - max_age,)
+            )
+        return cursor.rowcount
+
+    async def enqueue(self, chat_id, template_key, client_name, date):
+        return await self._call(self._enqueue, chat_id, template_key, client_name, date)
+
+    async def claim(self, owner):
+        return await self._call(self._claim, owner)
+
+    async def extend(self, job_id, owner):
+        return await self._call(
+            self._update_leased, job_id, owner, "lease_until = ?", (time.time() + self.lease_seconds,)
+        )
+
+    async def complete(self, job_id, owner):
+        return await self._call(
+            self._update_leased, job_id, owner, "status = 'done', lease_owner = NULL", ()
+        )
+
+    async def retry(self, job_id, owner, error, delay):
+        return await self._call(
+            self._update_leased, job_id, owner,
+            "status = 'queued', lease_owner = NULL, available_at = ?, last_error = ?",
+            (time.time() + delay, error),
+        )
+
+    async def fail(self, job_id, owner, error):
+        return await self._call(
+            self._update_leased, job_id, owner,
+            "status = 'failed', lease_owner = NULL, last_error = ?", (error,)
+        )
+
+    async def prune(self, max_age=JOB_RETENTION):
+        return await self._call(self._prune, max_age)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+job_queue = JobQueue(JOB_QUEUE_DB, JOB_QUEUE_MAX_PENDING, JOB_LEASE_SECONDS)
+
+async def enqueue_generation(message, template_key, client_name, date_str):
+    job_id, position = await job_queue.enqueue(message.chat_id, template_key, client_name, date_str)
+    if position is None:
+        logger.info(f"Запрос присоединен к задаче {job_id} в очереди для {client_name}")
+        await message.reply_text(WAIT_MESSAGE)
+        return "queue_deduplicated"
+    logger.info(f"Задача {job_id} поставлена в очередь для {client_name}")
+    await message.reply_text(f"{WAIT_MESSAGE}\nВы #{position} в очереди.")
+    return "queued"
+
+QUEUED_MESSAGE = "Документ поставлен в очередь и придёт отдельным сообщением."
+JOB_QUEUED_OUTCOMES = {"queued", "queue_deduplicated"}
+PROGRESSIVE_SENT_MESSAGE = "DOCX отправлен, PDF придёт отдельным сообщением."
+
+def next_step_message(outcome, done_text):
+    # В режиме очереди документ ещё не готов: его пришлет процесс-исполнитель,
+    # при прогрессивной доставке PDF еще конвертируется в фоне
+    if outcome in JOB_QUEUED_OUTCOMES:
+        text = QUEUED_MESSAGE
+    elif outcome == "progressive":
+        text = PROGRESSIVE_SENT_MESSAGE
+    else:
+        text = done_text
+    return f"{text} Что хотите сделать дальше?"
+
+async def deliver_document(bot, chat_id, template_key, client_name, date_str):
+    # То же, что send_generated_document, но без сообщения-источника: процесс-исполнитель
+    # отправляет PDF в чат напрямую через Bot API
+    template = template_store.get(template_key)
+    cache_key = ResultCache.key(template, render_variant(template), client_name, date_str)
+    file_id = await asyncio.to_thread(result_cache.file_id, cache_key)
+    if file_id is not None:
+        try:
+            with observe_stage("upload", template_key):
+                await bot.send_document(chat_id=chat_id, document=file_id)
+            return "file_id"
+        except telegram.error.TelegramError as e:
+            logger.warning(f"file_id из кэша недействителен: {e}")
+            await asyncio.to_thread(result_cache.forget_file_id, cache_key)
+    
+    outcome = "cache"
+    pdf_data = await asyncio.to_thread(result_cache.read, cache_key)
+    if pdf_data is None:
+        pdf_data, outcome = await generation_executor.run(render_document, template_key, client_name, date_str)
+        cache_key = ResultCache.key(template, outcome, client_name, date_str)
+        await asyncio.to_thread(result_cache.put, cache_key, pdf_data)
+    
+    with observe_stage("upload", template_key):
+        sent_message = await bot.send_document(
+            chat_id=chat_id, document=pdf_data, filename=f"{client_name}.pdf"
+        )
+    if sent_message.document is not None:
+        await asyncio.to_thread(result_cache.set_file_id, cache_key, sent_message.document.file_id)
+    return outcome
+
+async def keep_job_lease(job, owner):
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        if not await job_queue.extend(job.id, owner):
+            logger.warning(f"Аренда задачи {job.id} потеряна")
+            return
+
+async def process_job(bot, owner, job):
+    token = current_job_id.set(f"job{job.id}")
+    lease_task = asyncio.create_task(keep_job_lease(job, owner))
+    try:
+        if job.attempts > JOB_MAX_ATTEMPTS:
+            raise RuntimeError(f"аренда истекла на последней попытке ({job.attempts - 1})")
+        outcome = await deliver_document(bot, job.chat_id, job.template_key, job.client_name, job.date)
+        if not await job_queue.complete(job.id, owner):
+            logger.warning(f"Задача {job.id} выполнена после потери аренды")
+        DURABLE_JOBS.labels(outcome="done").inc()
+        GENERATIONS.labels(template=job.template_key, outcome=outcome).inc()
+        logger.info(f"Задача {job.id} выполнена для {job.client_name}")
+    except Exception as e:
+        if job.attempts < JOB_MAX_ATTEMPTS and not isinstance(e, JOB_PERMANENT_ERRORS):
+            delay = JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            await job_queue.retry(job.id, owner, repr(e), delay)
+            DURABLE_JOBS.labels(outcome="retried").inc()
+            logger.warning(f"Задача {job.id} (попытка {job.attempts}) не удалась, повтор через {delay} с: {e}")
+            return
+        await job_queue.fail(job.id, owner, repr(e))
+        DURABLE_JOBS.labels(outcome="failed").inc()
+        GENERATIONS.labels(template=job.template_key, outcome="error").inc()
+        logger.error(f"Задача {job.id} окончательно не выполнена: {e}")
+        try:
+            await bot.send_message(chat_id=job.chat_id, text=JOB_FAILED_MESSAGE)
+        except telegram.error.TelegramError as send_error:
+            logger.warning(f"Не удалось сообщить об ошибке задачи {job.id}: {send_error}")
+    finally:
+        lease_task.cancel()
+        current_job_id.reset(token)
+
+async def job_worker_loop(bot, owner, stop_event):
+    # Текущая задача дорабатывается до конца; при жесткой остановке ее
+    # заберет другой процесс после истечения аренды
+    while not stop_event.is_set():
+        job = await job_queue.claim(owner)
+        if job is None:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop_event.wait(), JOB_POLL_INTERVAL)
+            continue
+        await process_job(bot, owner, job)
+
+async def run_job_worker():
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    if WORKER_METRICS_PORT:
+        start_http_server(WORKER_METRICS_PORT)
+    try:
+        await loop.run_in_executor(None, warm_up_services)
+        async with telegram.Bot(BOT_TOKEN) as bot:
+            logger.info(f"Исполнитель {owner} запущен, потоков: {WORKER_CONCURRENCY}")
+            await asyncio.gather(*(
+                job_worker_loop(bot, owner, stop_event) for _ in range(WORKER_CONCURRENCY)
+            ))
+    finally:
+        generation_executor.shutdown()
+        job_queue.close()
+        converter_pool.close()
+
+# Поэтапная доставка (DELIVERY_MODE=progressive): DOCX отправляется сразу после
+# подстановки, PDF конвертируется в фоне и приходит следующим сообщением.
+# Фоновые задачи хранятся по чатам, чтобы их можно было отменить.
+DELIVERY_MODE = os.environ.get("DELIVERY_MODE", "pdf")
+PROGRESSIVE_MESSAGE = "DOCX готов, PDF пришлю следующим сообщением..."
+PDF_FAILED_MESSAGE = "Не удалось подготовить PDF. DOCX-версия документа отправлена выше."
+
+background_deliveries = {}
+
+def track_background_delivery(chat_id, coroutine):
+    task = asyncio.create_task(coroutine)
+    tasks = background_deliveries.setdefault(chat_id, set())
+    tasks.add(task)
+    
+    def forget(done_task):
+        tasks.discard(done_task)
+        if not tasks and background_deliveries.get(chat_id) is tasks:
+            del background_deliveries[chat_id]
+    
+    task.add_done_callback(forget)
+    return task
+
+def cancel_background_deliveries(chat_id):
+    tasks = background_deliveries.pop(chat_id, set())
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        logger.info(f"Отменено фоновых конвертаций в чате {chat_id}: {len(tasks)}")
+    return len(tasks)
+
+async def send_progressive_document(
+    message, status_message, inflight_key, template, client_name, date_str, progress=None
+):
+    # Подстановка тоже идет через пул генерации: при сброшенной раскладке
+    # штамповки она может запустить калибровку в LibreOffice
+    data, variant = await generation_executor.run(
+        prepare_document, template.key, client_name, date_str, message.chat_id, progress=progress
+    )
+    if variant == "stamp":
+        # Шаблон успел откалиброваться: PDF уже готов
+        cache_key = ResultCache.key(template, variant, client_name, date_str)
+        await asyncio.to_thread(result_cache.put, cache_key, data)
+        with observe_stage("upload", template.key):
+            sent_message = await message.reply_document(document=data, filename=f"{client_name}.pdf")
+        if sent_message.document is not None:
+            await asyncio.to_thread(result_cache.set_file_id, cache_key, sent_message.document.file_id)
+        return variant
+    
+    with observe_stage("upload_docx", template.key):
+        await message.reply_document(document=data.getvalue(), filename=f"{client_name}.docx")
+    try:
+        await status_message.edit_text(PROGRESSIVE_MESSAGE)
+    except telegram.error.TelegramError as e:
+        logger.warning(f"Не удалось обновить сообщение о генерации: {e}")
+    
+    # Повторный запрос того же документа присоединится к фоновой конвертации
+    pending = asyncio.get_running_loop().create_future()
+    inflight_generations[inflight_key] = pending
+    track_background_delivery(
+        message.chat_id,
+        deliver_pdf_in_background(
+            message, status_message, inflight_key, template, variant, client_name, date_str, data, pending
+        ),
+    )
+    return "progressive"
+
+async def deliver_pdf_in_background(
+    message, status_message, inflight_key, template, variant, client_name, date_str, data, pending
+):
+    async def report_position(position):
+        try:
+            await status_message.edit_text(f"{PROGRESSIVE_MESSAGE}\nВы #{position} в очереди.")
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Не удалось обновить позицию в очереди: {e}")
+    
+    try:
+        with observe_stage("background_pdf", template.key):
+            try:
+                pdf_data = await generation_executor.run(
+                    convert_document, data, template.key, client_name, progress=report_position
+                )
+                cache_key = ResultCache.key(template, variant, client_name, date_str)
+                await asyncio.to_thread(result_cache.put, cache_key, pdf_data)
+                pending.set_result((pdf_data, cache_key))
+            except asyncio.CancelledError:
+                pending.cancel()
+                raise
+            except Exception as e:
+                pending.set_exception(e)
+                pending.exception()
+                raise
+            finally:
+                inflight_generations.pop(inflight_key, None)
+            
+            with observe_stage("upload", template.key):
+                sent_message = await message.reply_document(document=pdf_data, filename=f"{client_name}.pdf")
+            if sent_message.document is not None:
+                await asyncio.to_thread(result_cache.set_file_id, cache_key, sent_message.document.file_id)
+        logger.info(f"PDF доставлен в фоне для {client_name}")
+    except asyncio.CancelledError:
+        logger.info(f"Фоновая конвертация для {client_name} отменена")
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка фоновой конвертации для {client_name}: {e}")
+        try:
+            await message.reply_text(PDF_FAILED_MESSAGE)
+        except telegram.error.TelegramError as send_error:
+            logger.warning(f"Не удалось сообщить об ошибке конвертации: {send_error}")
+
+# Пакетная генерация: подстановка и конвертация идут конвейером, PDF
+# собираются в один ZIP
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 200))
+BATCH_CHUNK_SIZE = int(os.environ.get("BATCH_CHUNK_SIZE", 10))
+BATCH_SUBSTITUTION_WORKERS = int(os.environ.get("BATCH_SUBSTITUTION_WORKERS", 4))
+BATCH_PROGRESS_EVERY = int(os.environ.get("BATCH_PROGRESS_EVERY", 5))
+BATCH_MAX_FILE_SIZE = 1024 * 1024
+
+BATCH_MAX_REPORTED_ERRORS = 10
+BATCH_HEADER_NAMES = {"name", "client", "client_name", "имя", "клиент", "фио"}
+
+def parse_batch_rows(text, default_date, is_csv=False):
+    # В тексте сообщения дата отделяется только «;» или табуляцией: запятая
+    # встречается в самих именах («Ivanov, Ivan»). В CSV-файле столбцы через запятую.
+    # Строки с неверной датой не срывают весь пакет, а возвращаются списком ошибок.
+    rows = []
+    errors = []
+    if is_csv:
+        lines = csv.reader(io.StringIO(text), skipinitialspace=True)
+    else:
+        lines = (re.split(r"[;\t]", line) for line in text.splitlines())
+    first_row = True
+    for line_number, row in enumerate(lines, start=1):
+        cells = [cell.strip() for cell in row if cell.strip()]
+        if not cells:
+            continue
+        if is_csv and len(cells) == 1:
+            cells = [cell.strip() for cell in re.split(r"[;\t]", cells[0]) if cell.strip()]
+        if first_row:
+            first_row = False
+            # Строка заголовка CSV («name,date»)
+            if cells[0].casefold() in BATCH_HEADER_NAMES:
+                continue
+        client_name = cells[0]
+        date_str = default_date
+        if len(cells) > 1:
+            try:
+                date_str = parse(cells[1]).strftime("%Y-%m-%d")
+            except (ValueError, OverflowError):
+                errors.append(f"строка {line_number}: неверная дата «{cells[1]}»")
+                continue
+        rows.append((client_name, date_str))
+    return rows, errors
+
+def format_batch_errors(errors):
+    text = "; ".join(errors[:BATCH_MAX_REPORTED_ERRORS])
+    if len(errors) > BATCH_MAX_REPORTED_ERRORS:
+        text += f" и ещё {len(errors) - BATCH_MAX_REPORTED_ERRORS}"
+    return text
+
+def batch_archive_name(client_name, used_names):
+    base = re.sub(r'[\\/:*?"<>|]+', "_", client_name).strip() or "document"
+    name = f"{base}.pdf"
+    counter = 2
+    while name in used_names:
+        name = f"{base} ({counter}).pdf"
+        counter += 1
+    used_names.add(name)
+    return name
+
+def run_batch(template_key, rows, scratch_dir, progress):
+    template = template_store.get(template_key)
+    layout = stamp_registry.layout(template)
+    zip_path = os.path.join(scratch_dir, f"{template_key}.zip")
+    failed = []
+    done = 0
+    
+    def substitute(index, client_name, date_str):
+        doc_path = os.path.join(scratch_dir, f"{index}.docx")
+        buffer = substitute_document(template_key, client_name, date_str)
+        with open(doc_path, "wb") as f:
+            f.write(buffer.getbuffer())
+        return doc_path
+    
+    def convert_chunk(chunk):
+        # Ждём подстановку своей порции и отдаём её одному вызову конвертера
+        ready = []
+        for index, future in chunk:
+            try:
+                ready.append((index, future.result()))
+            except Exception as e:
+                logger.error(f"Пакет {template_key}: ошибка подстановки для {rows[index][0]}: {e}")
+                failed.append(rows[index][0])
+        if ready:
+            converter_pool.convert_many([doc_path for _, doc_path in ready], scratch_dir)
+            for index, _ in ready:
+                pdf_path = os.path.join(scratch_dir, f"{index}.pdf")
+                if os.path.exists(pdf_path):
+                    pdf_postprocessor.process_file(pdf_path, template_key)
+        return [(index, os.path.join(scratch_dir, f"{index}.pdf")) for index, _ in ready]
+    
+    def stamp_chunk(chunk):
+        results = []
+        for index, _ in chunk:
+            client_name, date_str = rows[index]
+            pdf_path = os.path.join(scratch_dir, f"{index}.pdf")
+            with open(pdf_path, "wb") as f:
+                stamp_registry.stamp(layout, {"client": client_name, "date": date_str}, f)
+            results.append((index, pdf_path))
+        return results
+    
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as archive, \
+            ThreadPoolExecutor(max_workers=BATCH_SUBSTITUTION_WORKERS) as substitution, \
+            ThreadPoolExecutor(max_workers=converter_pool.size) as conversion:
+        if layout is not None:
+            chunks = [[(index, None)] for index in range(len(rows))]
+            conversions = {conversion.submit(stamp_chunk, chunk): chunk for chunk in chunks}
+        else:
+            substitutions = [
+                (index, substitution.submit(substitute, index, client_name, date_str))
+                for index, (client_name, date_str) in enumerate(rows)
+            ]
+            chunks = [
+                substitutions[start:start + BATCH_CHUNK_SIZE]
+                for start in range(0, len(substitutions), BATCH_CHUNK_SIZE)
+            ]
+            conversions = {conversion.submit(convert_chunk, chunk): chunk for chunk in chunks}
+        
+        used_names = set()
+        for future in as_completed(conversions):
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error(f"Пакет {template_key}: ошибка конвертации порции: {e}")
+                results = []
+                failed.extend(rows[index][0] for index, _ in conversions[future])
+            for index, pdf_path in results:
+                if not os.path.exists(pdf_path):
+                    failed.append(rows[index][0])
+                    continue
+                archive.write(pdf_path, batch_archive_name(rows[index][0], used_names))
+                os.remove(pdf_path)
+                done += 1
+                if done % BATCH_PROGRESS_EVERY == 0:
+                    progress(done, len(rows))
+    progress(done, len(rows))
+    return zip_path, done, failed
+
+async def send_batch(message, template_key, rows):
+    if generation_executor.queue_depth >= generation_executor.max_queue:
+        raise GenerationQueueFull()
+    
+    loop = asyncio.get_running_loop()
+    status_message = await message.reply_text(f"Пакетная генерация: 0/{len(rows)}")
+    
+    async def edit_status(text):
+        try:
+            await status_message.edit_text(text)
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Не удалось обновить прогресс пакета: {e}")
+    
+    def report_progress(done, total):
+        asyncio.run_coroutine_threadsafe(edit_status(f"Пакетная генерация: {done}/{total}"), loop)
+    
+    async def report_position(position):
+        await edit_status(f"Пакетная генерация: 0/{len(rows)}\nВы #{position} в очереди.")
+    
+    with job_scratch(prefix="batch_", root=SCRATCH_DISK_ROOT) as scratch_dir:
+        zip_path, done, failed = await generation_executor.run(
+            run_batch, template_key, rows, scratch_dir, report_progress,
+            progress=report_position,
+        )
+        if done:
+            with open(zip_path, "rb") as f:
+                await message.reply_document(document=f, filename=f"{template_key}_{len(rows)}.zip")
+    return done, failed
+
+# Экспорт всех закладок одним архивом: закладки читаются из базы порциями,
+# документы рендерятся параллельно через общую очередь генерации (готовые
+# берутся из кэша результатов), PDF сразу дописываются в ZIP на диске.
+# Архив больше BOOKMARKS_EXPORT_PART_SIZE отправляется частями.
+BOOKMARKS_EXPORT_CHUNK = int(os.environ.get("BOOKMARKS_EXPORT_CHUNK", 50))
+BOOKMARKS_EXPORT_CONCURRENCY = int(os.environ.get("BOOKMARKS_EXPORT_CONCURRENCY", GENERATION_WORKERS))
+BOOKMARKS_EXPORT_PART_SIZE = int(os.environ.get("BOOKMARKS_EXPORT_PART_SIZE", 45 * 1024 * 1024))
+BOOKMARKS_EXPORT_RETRY_DELAY = 1
+
+async def iter_bookmarks(user_id, new_date=None, chunk_size=BOOKMARKS_EXPORT_CHUNK):
+    # Закладки уникальны по (клиент, шаблон, дата); с новой датой документы
+    # совпадают уже по паре клиент-шаблон, и повторы отсекает GROUP BY в базе
+    if new_date is not None:
+        after = None
+        while True:
+            rows, has_more = await bookmark_store.documents_page(user_id, after, chunk_size)
+            for client_name, template_key in rows:
+                yield client_name, template_key, new_date
+            if not has_more:
+                return
+            after = rows[-1]
+    
+    after_id = 0
+    while True:
+        rows, has_more = await bookmark_store.page(user_id, after_id, chunk_size)
+        for _, client_name, template_key, date in rows:
+            yield client_name, template_key, date
+        if not has_more:
+            return
+        after_id = rows[-1][0]
+
+async def export_document(template_key, client_name, date_str):
+    template = template_store.get(template_key)
+    cache_key = ResultCache.key(template, render_variant(template), client_name, date_str)
+    pdf_data = await asyncio.to_thread(result_cache.read, cache_key)
+    if pdf_data is not None:
+        return pdf_data, True
+    
+    # Экспорт уступает место в очереди интерактивным запросам
+    while True:
+        try:
+            pdf_data, variant = await generation_executor.run(
+                render_document, template_key, client_name, date_str
+            )
+            break
+        except GenerationQueueFull:
+            await asyncio.sleep(BOOKMARKS_EXPORT_RETRY_DELAY)
+    cache_key = ResultCache.key(template, variant, client_name, date_str)
+    await asyncio.to_thread(result_cache.put, cache_key, pdf_data)
+    return pdf_data, False
+
+async def send_bookmarks_export(message, user_id, new_date=None):
+    status_message = await message.reply_text("Экспорт закладок: подготовка...")
+    stats = {"done": 0, "cached": 0, "parts": 0}
+    failed = []
+    archive = None
+    archive_path = None
+    used_names = set()
+    
+    async def edit_status(text):
+        try:
+            await status_message.edit_text(text)
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Не удалось обновить прогресс экспорта: {e}")
+    
+    async def send_archive():
+        nonlocal archive
+        archive.close()
+        archive = None
+        stats["parts"] += 1
+        with open(archive_path, "rb") as f:
+            await message.reply_document(document=f, filename=f"bookmarks_{stats['parts']}.zip")
+        os.remove(archive_path)
+    
+    async def collect(tasks):
+        nonlocal archive, archive_path, used_names
+        for task in tasks:
+            client_name, date_str, pdf_data, cached = task.result()
+            if pdf_data is None:
+                failed.append(f"{client_name} ({date_str})")
+                continue
+            if archive is None:
+                archive_path = os.path.join(scratch_dir, f"part_{stats['parts'] + 1}.zip")
+                archive = zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_DEFLATED)
+                used_names = set()
+            name = batch_archive_name(f"{client_name} {date_str}", used_names)
+            await asyncio.to_thread(archive.writestr, name, pdf_data)
+            stats["done"] += 1
+            stats["cached"] += cached
+            if stats["done"] % BATCH_PROGRESS_EVERY == 0:
+                await edit_status(f"Экспорт закладок: {stats['done']}")
+            if os.path.getsize(archive_path) >= BOOKMARKS_EXPORT_PART_SIZE:
+                await send_archive()
+    
+    async def export_item(template_key, client_name, date_str):
+        try:
+            return (client_name, date_str, *await export_document(template_key, client_name, date_str))
+        except Exception as e:
+            logger.error(f"Экспорт закладок: ошибка для {client_name} ({template_key}, {date_str}): {e}")
+            return client_name, date_str, None, False
+    
+    pending = set()
+    with job_scratch(prefix="export_", root=SCRATCH_DISK_ROOT) as scratch_dir:
+        try:
+            async for client_name, template_key, date_str in iter_bookmarks(user_id, new_date):
+                pending.add(asyncio.create_task(export_item(template_key, client_name, date_str)))
+                if len(pending) >= BOOKMARKS_EXPORT_CONCURRENCY:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    await collect(finished)
+            if pending:
+                finished, pending = await asyncio.wait(pending)
+                await collect(finished)
+            if archive is not None:
+                await send_archive()
+        finally:
+            for task in pending:
+                task.cancel()
+            if archive is not None:
+                archive.close()
+    return stats["done"], stats["cached"], failed
+
+async def run_bookmarks_export(message, user_id, new_date):
+    try:
+        done, cached, failed = await send_bookmarks_export(message, user_id, new_date)
+        summary = f"Экспорт закладок готов: {done} документов, из кэша {cached}."
+        if failed:
+            summary += f"\nНе удалось создать: {', '.join(failed)}"
+        await message.reply_text(summary)
+    except asyncio.CancelledError:
+        logger.info(f"Экспорт закладок пользователя {user_id} отменен")
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка экспорта закладок: {e}")
+        await message.reply_text(
+            "Произошла ошибка при экспорте закладок. Попробуйте снова или свяжитесь с поддержкой."
+        )
+
+@instrumented_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    session_artifacts.discard(update.effective_chat.id)
     keyboard = [
         [InlineKeyboardButton("UR Recruitment", callback_data="ur_recruitment")],
         [InlineKeyboardButton("Small World", callback_data="small_world")],
@@ -155,6 +2756,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return SELECT_TEMPLATE
 
+@instrumented_handler
 async def select_template(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -165,34 +2767,22 @@ async def select_template(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.message.reply_text("Введите имя клиента:")
     return INPUT_NAME
 
+@instrumented_handler
 async def receive_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     client_name = update.message.text.strip()
     context.user_data["client_name"] = client_name
     
     template_key = context.user_data["template_key"]
-    template_path = os.path.join("templates", TEMPLATES[template_key])
     
     # Получение текущей даты в Киеве
-    kyiv_tz = ZoneInfo("Europe/Kiev")
-    current_date = datetime.now(kyiv_tz).strftime("%Y-%m-%d")
+    current_date = kyiv_today()
     context.user_data["date"] = current_date
     
     try:
-        # Сообщение о начале генерации
-        await update.message.reply_text("Ожидайте, ваш документ генерируется...")
-        
-        # Обработка документа
-        temp_doc = replace_client_and_date(template_path, client_name, current_date, template_key)
-        pdf_path = convert_to_pdf(temp_doc, client_name)
-        
-        # Отправка PDF
-        with open(pdf_path, "rb") as f:
-            await update.message.reply_document(document=f, filename=f"{client_name}.pdf")
-        
-        # Очистка временных файлов
-        os.remove(temp_doc)
-        os.remove(pdf_path)
-        logger.info(f"Временные файлы удалены: {temp_doc}, {pdf_path}")
+        # Генерация в пуле вне цикла событий с отправкой PDF
+        outcome = await send_generated_document(
+            update.message, update.effective_user.id, template_key, client_name, current_date
+        )
         
         # Предложение добавить в закладки, изменить дату или сгенерировать новый документ
         keyboard = [
@@ -204,10 +2794,13 @@ async def receive_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await update.message.reply_text(
-            "Документ сгенерирован! Что хотите сделать дальше?",
+            next_step_message(outcome, "Документ сгенерирован!"),
             reply_markup=reply_markup
         )
         return CHANGE_DATE
+    except GenerationQueueFull:
+        await update.message.reply_text(QUEUE_FULL_MESSAGE)
+        return INPUT_NAME
     except Exception as e:
         logger.error(f"Ошибка в receive_name: {e}")
         await update.message.reply_text(
@@ -215,6 +2808,7 @@ async def receive_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
 
+@instrumented_handler
 async def bookmark(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -225,21 +2819,17 @@ async def bookmark(update: Update, context: ContextTypes.DEFAULT_TYPE):
     date = context.user_data["date"]
     
     try:
-        conn = sqlite3.connect("bookmarks.db")
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO bookmarks (user_id, client_name, template_name, date) VALUES (?, ?, ?, ?)",
-            (user_id, client_name, template_key, date)
-        )
-        conn.commit()
-        conn.close()
-        await query.message.reply_text("Документ успешно добавлен в закладки!")
+        if await bookmark_store.add(user_id, client_name, template_key, date):
+            await query.message.reply_text("Документ успешно добавлен в закладки!")
+        else:
+            await query.message.reply_text("Этот документ уже есть в закладках.")
     except Exception as e:
         logger.error(f"Ошибка при добавлении закладки: {e}")
         await query.message.reply_text("Ошибка при сохранении закладки. Попробуйте снова.")
     
     return CHANGE_DATE
 
+@instrumented_handler
 async def change_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -247,6 +2837,7 @@ async def change_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.message.reply_text("Введите новую дату (например, 2025-04-28, 28.04.2025, 28/04/2025 и т.д.):")
     return INPUT_NEW_DATE
 
+@instrumented_handler
 async def receive_new_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     new_date_input = update.message.text.strip()
     try:
@@ -260,24 +2851,12 @@ async def receive_new_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["date"] = new_date
     client_name = context.user_data["client_name"]
     template_key = context.user_data["template_key"]
-    template_path = os.path.join("templates", TEMPLATES[template_key])
     
     try:
-        # Сообщение о начале генерации
-        await update.message.reply_text("Ожидайте, ваш документ генерируется...")
-        
-        # Обработка документа с новой датой
-        temp_doc = replace_client_and_date(template_path, client_name, new_date, template_key)
-        pdf_path = convert_to_pdf(temp_doc, client_name)
-        
-        # Отправка PDF
-        with open(pdf_path, "rb") as f:
-            await update.message.reply_document(document=f, filename=f"{client_name}.pdf")
-        
-        # Очистка временных файлов
-        os.remove(temp_doc)
-        os.remove(pdf_path)
-        logger.info(f"Временные файлы удалены: {temp_doc}, {pdf_path}")
+        # Генерация в пуле вне цикла событий с отправкой PDF
+        outcome = await send_generated_document(
+            update.message, update.effective_user.id, template_key, client_name, new_date
+        )
         
         # Предложение вариантов
         keyboard = [
@@ -289,10 +2868,13 @@ async def receive_new_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await update.message.reply_text(
-            "Документ обновлен с новой датой! Что хотите сделать дальше?",
+            next_step_message(outcome, "Документ обновлен с новой датой!"),
             reply_markup=reply_markup
         )
         return CHANGE_DATE
+    except GenerationQueueFull:
+        await update.message.reply_text(QUEUE_FULL_MESSAGE)
+        return INPUT_NEW_DATE
     except Exception as e:
         logger.error(f"Ошибка в receive_new_date: {e}")
         await update.message.reply_text(
@@ -300,37 +2882,28 @@ async def receive_new_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
 
+@instrumented_handler
 async def generate_another(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
+    session_artifacts.discard(update.effective_chat.id)
     await query.message.reply_text("Введите имя нового клиента:")
     return GENERATE_ANOTHER
 
+@instrumented_handler
 async def receive_another_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     client_name = update.message.text.strip()
     context.user_data["client_name"] = client_name
     
     template_key = context.user_data["template_key"]
     date = context.user_data["date"]
-    template_path = os.path.join("templates", TEMPLATES[template_key])
     
     try:
-        # Сообщение о начале генерации
-        await update.message.reply_text("Ожидайте, ваш документ генерируется...")
-        
-        # Обработка документа
-        temp_doc = replace_client_and_date(template_path, client_name, date, template_key)
-        pdf_path = convert_to_pdf(temp_doc, client_name)
-        
-        # Отправка PDF
-        with open(pdf_path, "rb") as f:
-            await update.message.reply_document(document=f, filename=f"{client_name}.pdf")
-        
-        # Очистка временных файлов
-        os.remove(temp_doc)
-        os.remove(pdf_path)
-        logger.info(f"Временные файлы удалены: {temp_doc}, {pdf_path}")
+        # Генерация в пуле вне цикла событий с отправкой PDF
+        outcome = await send_generated_document(
+            update.message, update.effective_user.id, template_key, client_name, date
+        )
         
         # Предложение вариантов
         keyboard = [
@@ -342,10 +2915,13 @@ async def receive_another_name(update: Update, context: ContextTypes.DEFAULT_TYP
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await update.message.reply_text(
-            "Документ сгенерирован! Что хотите сделать дальше?",
+            next_step_message(outcome, "Документ сгенерирован!"),
             reply_markup=reply_markup
         )
         return CHANGE_DATE
+    except GenerationQueueFull:
+        await update.message.reply_text(QUEUE_FULL_MESSAGE)
+        return GENERATE_ANOTHER
     except Exception as e:
         logger.error(f"Ошибка в receive_another_name: {e}")
         await update.message.reply_text(
@@ -353,11 +2929,14 @@ async def receive_another_name(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return ConversationHandler.END
 
+@instrumented_handler
 async def start_over(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     context.user_data.clear()
+    session_artifacts.discard(update.effective_chat.id)
+    cancel_background_deliveries(update.effective_chat.id)
     keyboard = [
         [InlineKeyboardButton("UR Recruitment", callback_data="ur_recruitment")],
         [InlineKeyboardButton("Small World", callback_data="small_world")],
@@ -371,36 +2950,38 @@ async def start_over(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return SELECT_TEMPLATE
 
+def bookmarks_keyboard(bookmarks, has_more, first_page):
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                f"{client_name} ({template_name}, {date})",
+                callback_data=f"bm:{bookmark_id}"
+            )
+        ]
+        for bookmark_id, client_name, template_name, date in bookmarks
+    ]
+    navigation = []
+    if not first_page:
+        navigation.append(InlineKeyboardButton("« В начало", callback_data="bmpage:0"))
+    if has_more:
+        navigation.append(InlineKeyboardButton("Далее »", callback_data=f"bmpage:{bookmarks[-1][0]}"))
+    if navigation:
+        keyboard.append(navigation)
+    return InlineKeyboardMarkup(keyboard)
+
+@instrumented_handler
 async def view_bookmarks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     try:
-        conn = sqlite3.connect("bookmarks.db")
-        c = conn.cursor()
-        c.execute(
-            "SELECT client_name, template_name, date FROM bookmarks WHERE user_id = ?",
-            (user_id,)
-        )
-        bookmarks = c.fetchall()
-        conn.close()
+        bookmarks, has_more = await bookmark_store.page(user_id)
         
         if not bookmarks:
             await update.message.reply_text("У вас нет сохраненных закладок.")
             return ConversationHandler.END
         
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    f"{client_name} ({template_name}, {date})",
-                    callback_data=f"bookmark_{client_name}_{template_name}_{date}"
-                )
-            ]
-            for client_name, template_name, date in bookmarks
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await update.message.reply_text(
             "Выберите сохраненный документ для повторной генерации:",
-            reply_markup=reply_markup
+            reply_markup=bookmarks_keyboard(bookmarks, has_more, first_page=True)
         )
         return VIEW_BOOKMARKS
     except Exception as e:
@@ -408,33 +2989,49 @@ async def view_bookmarks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Ошибка при загрузке закладок. Попробуйте снова.")
         return ConversationHandler.END
 
+@instrumented_handler
+async def bookmarks_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    after_id = int(query.data.split(":", 1)[1])
+    try:
+        bookmarks, has_more = await bookmark_store.page(query.from_user.id, after_id)
+        if not bookmarks:
+            bookmarks, has_more = await bookmark_store.page(query.from_user.id)
+            after_id = 0
+        await query.edit_message_reply_markup(
+            reply_markup=bookmarks_keyboard(bookmarks, has_more, first_page=not after_id)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при листании закладок: {e}")
+        await query.message.reply_text("Ошибка при загрузке закладок. Попробуйте снова.")
+    return VIEW_BOOKMARKS
+
+@instrumented_handler
 async def regenerate_bookmark(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    _, client_name, template_key, date = query.data.split("_", 3)
+    bookmark_id = int(query.data.split(":", 1)[1])
+    try:
+        saved = await bookmark_store.get(query.from_user.id, bookmark_id)
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке закладки: {e}")
+        saved = None
+    if saved is None:
+        await query.message.reply_text("Закладка не найдена. Выберите другую.")
+        return VIEW_BOOKMARKS
+    _, client_name, template_key, date = saved
     context.user_data["client_name"] = client_name
     context.user_data["template_key"] = template_key
     context.user_data["date"] = date
     
-    template_path = os.path.join("templates", TEMPLATES[template_key])
-    
     try:
-        # Сообщение о начале генерации
-        await query.message.reply_text("Ожидайте, ваш документ генерируется...")
-        
-        # Обработка документа
-        temp_doc = replace_client_and_date(template_path, client_name, date, template_key)
-        pdf_path = convert_to_pdf(temp_doc, client_name)
-        
-        # Отправка PDF
-        with open(pdf_path, "rb") as f:
-            await query.message.reply_document(document=f, filename=f"{client_name}.pdf")
-        
-        # Очистка временных файлов
-        os.remove(temp_doc)
-        os.remove(pdf_path)
-        logger.info(f"Временные файлы удалены: {temp_doc}, {pdf_path}")
+        # Генерация в пуле вне цикла событий с отправкой PDF
+        outcome = await send_generated_document(
+            query.message, update.effective_user.id, template_key, client_name, date
+        )
         
         # Предложение вариантов
         keyboard = [
@@ -446,10 +3043,13 @@ async def regenerate_bookmark(update: Update, context: ContextTypes.DEFAULT_TYPE
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.message.reply_text(
-            "Документ повторно сгенерирован! Что хотите сделать дальше?",
+            next_step_message(outcome, "Документ повторно сгенерирован!"),
             reply_markup=reply_markup
         )
         return CHANGE_DATE
+    except GenerationQueueFull:
+        await query.message.reply_text(QUEUE_FULL_MESSAGE)
+        return VIEW_BOOKMARKS
     except Exception as e:
         logger.error(f"Ошибка в regenerate_bookmark: {e}")
         await query.message.reply_text(
@@ -457,9 +3057,114 @@ async def regenerate_bookmark(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return ConversationHandler.END
 
+@instrumented_handler
+async def batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [
+        [InlineKeyboardButton("UR Recruitment", callback_data="batch_ur_recruitment")],
+        [InlineKeyboardButton("Small World", callback_data="batch_small_world")],
+        [InlineKeyboardButton("Imperative", callback_data="batch_imperative")],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await update.message.reply_text(
+        "Пакетная генерация. Выберите шаблон:",
+        reply_markup=reply_markup
+    )
+    return BATCH_SELECT_TEMPLATE
+
+@instrumented_handler
+async def select_batch_template(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    context.user_data["batch_template_key"] = query.data[len("batch_"):]
+    
+    await query.message.reply_text(
+        "Отправьте список клиентов: по одному имени в строке, дату можно указать "
+        "через точку с запятой или табуляцию (например, «Ivan Petrov; 28.04.2025»). "
+        "Можно загрузить CSV-файл со столбцами имя и дата, строка заголовка допускается. "
+        f"Не более {BATCH_MAX_ITEMS} строк."
+    )
+    return BATCH_INPUT
+
+@instrumented_handler
+async def receive_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    template_key = context.user_data["batch_template_key"]
+    
+    # Текущая дата в Киеве для строк без даты
+    current_date = kyiv_today()
+    
+    try:
+        if update.message.document is not None:
+            if (update.message.document.file_size or 0) > BATCH_MAX_FILE_SIZE:
+                await update.message.reply_text("Файл слишком большой. Попробуйте снова.")
+                return BATCH_INPUT
+            telegram_file = await update.message.document.get_file()
+            text = bytes(await telegram_file.download_as_bytearray()).decode("utf-8-sig")
+            rows, errors = parse_batch_rows(text, current_date, is_csv=True)
+        else:
+            rows, errors = parse_batch_rows(update.message.text, current_date)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        await update.message.reply_text(f"Не удалось разобрать список: {e}. Попробуйте снова.")
+        return BATCH_INPUT
+    
+    if not rows:
+        if errors:
+            await update.message.reply_text(
+                f"Не удалось разобрать список: {format_batch_errors(errors)}. Попробуйте снова."
+            )
+        else:
+            await update.message.reply_text("Список пуст. Попробуйте снова.")
+        return BATCH_INPUT
+    if len(rows) > BATCH_MAX_ITEMS:
+        await update.message.reply_text(f"Слишком много строк ({len(rows)}), максимум {BATCH_MAX_ITEMS}.")
+        return BATCH_INPUT
+    
+    try:
+        done, failed = await send_batch(update.message, template_key, rows)
+        summary = f"Пакет готов: {done} из {len(rows)} документов."
+        if failed:
+            summary += f"\nНе удалось создать: {', '.join(failed)}"
+        if errors:
+            summary += f"\nПропущены строки: {format_batch_errors(errors)}"
+        await update.message.reply_text(summary)
+    except GenerationQueueFull:
+        await update.message.reply_text(QUEUE_FULL_MESSAGE)
+        return BATCH_INPUT
+    except Exception as e:
+        logger.error(f"Ошибка в receive_batch: {e}")
+        await update.message.reply_text(
+            "Произошла ошибка при пакетной генерации. Попробуйте снова или свяжитесь с поддержкой."
+        )
+    context.user_data.pop("batch_template_key", None)
+    return ConversationHandler.END
+
+@instrumented_handler
+async def bookmarks_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /bookmarks_export [дата] — все закладки одним архивом, при необходимости с новой датой
+    new_date = None
+    if context.args:
+        try:
+            new_date = parse(" ".join(context.args)).strftime("%Y-%m-%d")
+        except (ValueError, OverflowError):
+            await update.message.reply_text("Неверный формат даты. Пример: /bookmarks_export 28.04.2025")
+            return
+    
+    user_id = update.effective_user.id
+    rows, _ = await bookmark_store.page(user_id, 0, 1)
+    if not rows:
+        await update.message.reply_text("У вас нет закладок.")
+        return
+    
+    # Экспорт идет в фоне: чат не блокируется, а /cancel может его прервать
+    track_background_delivery(update.effective_chat.id, run_bookmarks_export(update.message, user_id, new_date))
+
+@instrumented_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Операция отменена.")
     context.user_data.clear()
+    session_artifacts.discard(update.effective_chat.id)
+    cancel_background_deliveries(update.effective_chat.id)
     return ConversationHandler.END
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -474,48 +3179,330 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Произошла ошибка. Попробуйте снова или свяжитесь с поддержкой."
             )
 
-def main():
-    try:
-        application = (
-            Application.builder()
-            .token("7677140739:AAGJcf8uhIKVdY44jqDKKlRM84_4_ndlrps")
-            .build()
-        )
-        
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", start), CommandHandler("bookmarks", view_bookmarks)],
-            states={
-                SELECT_TEMPLATE: [CallbackQueryHandler(select_template)],
-                INPUT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_name)],
-                CHANGE_DATE: [
-                    CallbackQueryHandler(bookmark, pattern="bookmark"),
-                    CallbackQueryHandler(change_date, pattern="change_date"),
-                    CallbackQueryHandler(generate_another, pattern="generate_another"),
-                    CallbackQueryHandler(start_over, pattern="start_over"),
-                ],
-                INPUT_NEW_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_new_date)],
-                GENERATE_ANOTHER: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_another_name)],
-                VIEW_BOOKMARKS: [CallbackQueryHandler(regenerate_bookmark, pattern="bookmark_.*")],
-            },
-            fallbacks=[CommandHandler("cancel", cancel)],
-        )
+# Параллельная обработка обновлений: разные чаты обрабатываются одновременно,
+# обновления одного чата — строго по порядку
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 64))
+# Обычный сценарий (шаблон, имя, смена даты, закладки, пакет) — это десяток-другой
+# обновлений подряд: лимит должен отсекать только заведомо аномальный поток
+RATE_LIMIT_PER_MINUTE = int(os.environ.get("RATE_LIMIT_PER_MINUTE", 60))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 30))
+RATE_LIMIT_MESSAGE = "Слишком много запросов. Подождите немного и повторите."
+RATE_LIMIT_NOTIFY_INTERVAL = 10
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Чат сначала дожидается своей очереди и только потом занимает общий слот,
+    # поэтому один чат держит не больше одного слота, а ожидающие чаты получают
+    # слоты по кругу в порядке поступления. Частота обновлений от одного
+    # пользователя ограничена корзиной токенов.
+    # process_update в PTB 20.7 помечен @final и сам берет общий семафор;
+    # здесь он намеренно переопределен, чтобы брать _semaphore после блокировки
+    # чата. Поэтому версия PTB закреплена в requirements.txt, и при ее обновлении
+    # переопределение нужно сверить с BaseUpdateProcessor.
+    def __init__(self, max_concurrent_updates, rate_per_minute, burst, before_update=None):
+        super().__init__(max_concurrent_updates)
+        self.rate_per_second = rate_per_minute / 60
+        self.burst = burst
+        # Вызывается под блокировкой чата до разбора обновления обработчиками
+        self.before_update = before_update
+        self._chat_queues = {}
+        self._buckets = {}
+        self._limited_notified = {}
+
+    def _allow(self, user_id):
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate_per_second)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+            self._limited_notified.pop(user_id, None)
+        self._buckets[user_id] = (tokens, now)
+        return allowed
+
+    async def _notify_limited(self, update, user_id):
+        # Нажатие кнопки подтверждается всегда, иначе у клиента крутится индикатор
+        if update.callback_query is not None:
+            try:
+                await update.callback_query.answer(RATE_LIMIT_MESSAGE)
+            except telegram.error.TelegramError as e:
+                logger.warning(f"Не удалось ответить на нажатие кнопки: {e}")
+            return
+        # Об отброшенных сообщениях сообщаем не чаще раза в RATE_LIMIT_NOTIFY_INTERVAL
+        now = time.monotonic()
+        notified = self._limited_notified.get(user_id)
+        if update.effective_message is None or (notified is not None and now - notified < RATE_LIMIT_NOTIFY_INTERVAL):
+            return
+        self._limited_notified[user_id] = now
+        try:
+            await update.effective_message.reply_text(RATE_LIMIT_MESSAGE)
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Не удалось сообщить об ограничении частоты: {e}")
+
+    async def process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        chat = getattr(update, "effective_chat", None)
+        if user is not None and not self._allow(user.id):
+            coroutine.close()
+            logger.warning(f"Обновление от пользователя {user.id} отброшено: превышен лимит частоты")
+            await self._notify_limited(update, user.id)
+            return
         
-        application.add_handler(conv_handler)
-        application.add_error_handler(error_handler)
+        key = chat.id if chat is not None else (user.id if user is not None else None)
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
         
+        entry = self._chat_queues.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._chat_queues.pop(key, None)
+            # Корзины давно неактивных пользователей не нужны
+            if len(self._buckets) > 10000:
+                cutoff = time.monotonic() - self.burst / self.rate_per_second
+                self._buckets = {
+                    user_id: bucket for user_id, bucket in self._buckets.items() if bucket[1] > cutoff
+                }
+
+    async def do_process_update(self, update, coroutine):
+        if self.before_update is not None:
+            try:
+                await self.before_update(update)
+            except Exception as e:
+                logger.warning(f"Не удалось синхронизировать сессии перед обновлением: {e}")
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# Прогрев при старте: всё, за что иначе платит первый запрос после деплоя,
+# выполняется до регистрации вебхука
+WARMUP_TIMEOUT = int(os.environ.get("WARMUP_TIMEOUT", 180))
+WARMUP_CLIENT = "Warmup Client"
+
+warmup_state = {"status": "starting", "failed_templates": []}
+
+def warm_up_services(render=True):
+    started = time.monotonic()
+    warmup_state["status"] = "warming_up"
+    
+    # Кэш fontconfig строится один раз, а не в первой конвертации
+    fc_cache = shutil.which("fc-cache")
+    if fc_cache:
+        with observe_stage("warmup_fonts", "-"):
+            try:
+                subprocess.run([fc_cache], check=True, timeout=WARMUP_TIMEOUT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                logger.warning(f"Не удалось обновить кэш шрифтов: {e}")
+    
+    # Загрузка и проверка шаблонов до приема запросов
+    missing_templates = template_store.load_all()
+    if missing_templates:
+        logger.error(f"Отсутствуют шаблоны: {', '.join(missing_templates)}")
+    available = [key for key in TEMPLATES if key not in missing_templates]
+    failed = list(missing_templates)
+    
+    # Профили LibreOffice создаются с увеличенным таймаутом, первым шаблоном.
+    # В режиме очереди вебхук-процесс не рендерит: это делают исполнители
+    if render and available:
+        try:
+            with observe_stage("warmup_converter", available[0]), job_scratch(prefix="warmup_") as scratch:
+                doc_path = os.path.join(scratch, "warmup.docx")
+                with open(doc_path, "wb") as f:
+                    f.write(template_store.get(available[0]).content)
+                converter_pool.warm_up(doc_path, scratch, WARMUP_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Прогрев конвертера не удался: {e}")
+    
+    # Снимки на сегодня строятся заранее, и пробный рендер идет тем же путем,
+    # что и реальные запросы; для штампуемых шаблонов заодно выполняется калибровка
+    date_str = kyiv_today()
+    if render:
+        date_snapshots.refresh(available, date_str)
+    for template_key in available if render else []:
+        try:
+            with observe_stage("warmup_render", template_key):
+                render_document(template_key, WARMUP_CLIENT, date_str)
+        except Exception as e:
+            logger.error(f"Пробный рендер шаблона {template_key} не удался: {e}")
+            failed.append(template_key)
+    
+    warmup_state["failed_templates"] = failed
+    warmup_state["status"] = "ready"
+    logger.info(f"Прогрев завершен за {time.monotonic() - started:.1f} с")
+
+# Собственный веб-сервер вебхука: кроме /webhook отдает /metrics и /healthz
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_application):
+        self.bot_application = bot_application
+
+    async def post(self):
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_application.bot)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Некорректное обновление от Telegram: {e}")
+            raise tornado.web.HTTPError(400)
+        await self.bot_application.update_queue.put(update)
+        self.set_status(200)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.write(generate_latest())
+
+class HealthHandler(tornado.web.RequestHandler):
+    # Готовность: 200 только после прогрева, до этого 503
+    def get(self):
+        self.set_status(200 if warmup_state["status"] == "ready" else 503)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(warmup_state))
+
+async def run_webhook_server(application: Application):
+    port = int(os.environ.get("PORT", 8443))
+    webhook_url = f"https://{os.environ.get('RENDER_EXTERNAL_HOSTNAME')}/webhook"
+    web_app = tornado.web.Application([
+        (r"/webhook/?", WebhookHandler, {"bot_application": application}),
+        (r"/metrics", MetricsHandler),
+        (r"/healthz", HealthHandler),
+    ])
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    async with application:
+        # Сервер слушает порт уже во время прогрева, чтобы /healthz отвечал 503
+        server = web_app.listen(port, address="0.0.0.0")
+        try:
+            await loop.run_in_executor(
+                None, functools.partial(warm_up_services, render=GENERATION_MODE != "queue")
+            )
+            if stop_event.is_set():
+                return
+            await application.bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES)
+            await application.start()
+            logger.info(f"Вебхук {webhook_url} зарегистрирован, порт {port}")
+            await stop_event.wait()
+            await application.stop()
+        finally:
+            server.stop()
+            await shutdown_services(application)
+
+async def sweep_scratch(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(sweep_scratch_dirs)
+    if GENERATION_MODE == "queue":
+        removed = await job_queue.prune()
+        if removed:
+            logger.info(f"Удалено завершенных задач очереди: {removed}")
+
+async def refresh_date_snapshots(context: ContextTypes.DEFAULT_TYPE):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, date_snapshots.refresh, list(TEMPLATES), kyiv_today())
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    session_artifacts.evict_idle()
+    persistence = context.application.persistence
+    evicted = persistence.evict_idle()
+    removed = await persistence.purge()
+    if evicted or removed:
+        logger.info(f"Сессии: вытеснено из памяти {evicted}, удалено из базы {removed}")
+
+async def shutdown_services(application: Application):
+    for chat_id in list(background_deliveries):
+        cancel_background_deliveries(chat_id)
+    generation_executor.shutdown()
+    bookmark_store.close()
+    job_queue.close()
+    converter_pool.close()
+
+BOT_TOKEN = os.environ.get("TELEGRAM_TOKEN", "7677140739:AAGJcf8uhIKVdY44jqDKKlRM84_4_ndlrps")
+
+def build_application(builder=None):
+    # Та же сборка используется стендом нагрузочного тестирования (benchmark.py)
+    if builder is None:
+        builder = Application.builder().token(BOT_TOKEN)
+    persistence = SessionPersistence(SESSIONS_DB, SESSION_TTL, SESSION_WRITE_INTERVAL)
+    application = builder.persistence(persistence).concurrent_updates(
+        ChatOrderedUpdateProcessor(
+            MAX_CONCURRENT_UPDATES, RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST, before_update=persistence.sync
+        )
+    ).build()
+    persistence.attach(application)
+    
+    conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler("start", start),
+            CommandHandler("bookmarks", view_bookmarks),
+            CommandHandler("batch", batch),
+        ],
+        states={
+            SELECT_TEMPLATE: [CallbackQueryHandler(select_template)],
+            INPUT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_name)],
+            CHANGE_DATE: [
+                CallbackQueryHandler(bookmark, pattern="bookmark"),
+                CallbackQueryHandler(change_date, pattern="change_date"),
+                CallbackQueryHandler(generate_another, pattern="generate_another"),
+                CallbackQueryHandler(start_over, pattern="start_over"),
+            ],
+            INPUT_NEW_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_new_date)],
+            GENERATE_ANOTHER: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_another_name)],
+            VIEW_BOOKMARKS: [
+                CallbackQueryHandler(regenerate_bookmark, pattern=r"^bm:\d+$"),
+                CallbackQueryHandler(bookmarks_page, pattern=r"^bmpage:\d+$"),
+            ],
+            BATCH_SELECT_TEMPLATE: [CallbackQueryHandler(select_batch_template, pattern="^batch_")],
+            BATCH_INPUT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_batch),
+                MessageHandler(filters.Document.ALL, receive_batch),
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="main_conversation",
+        persistent=True,
+    )
+    
+    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("bookmarks_export", bookmarks_export))
+    application.add_error_handler(error_handler)
+    
+    # Периодическая чистка осиротевших рабочих каталогов
+    application.job_queue.run_repeating(sweep_scratch, interval=SCRATCH_SWEEP_INTERVAL, first=0)
+    # Вытеснение давно неактивных сессий из памяти и базы
+    application.job_queue.run_repeating(sweep_sessions, interval=SESSION_SWEEP_INTERVAL)
+    # Дневные заготовки шаблонов пересобираются в полночь по Киеву
+    if GENERATION_MODE != "queue":
+        application.job_queue.run_daily(refresh_date_snapshots, time=dtime(0, 0, tzinfo=KYIV_TZ))
+    return application
+
+def main():
+    try:
         # Проверка директории templates
-        if not os.path.exists("templates"):
+        if not os.path.exists(TEMPLATES_DIR):
             logger.error("Директория templates не найдена")
             raise FileNotFoundError("Директория templates не найдена")
         
-        # Запуск бота с вебхуком
+        # `python main.py worker` — процесс-исполнитель долговременной очереди
+        if sys.argv[1:2] == ["worker"]:
+            logger.info("Запуск исполнителя очереди генерации")
+            asyncio.run(run_job_worker())
+            return
+        
+        application = build_application()
+        
+        # Запуск бота с вебхуком; шаблоны и конвертер прогреваются до регистрации
         logger.info("Запуск приложения с вебхуком")
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=int(os.environ.get("PORT", 8443)),
-            url_path="/webhook",
-            webhook_url=f"https://{os.environ.get('RENDER_EXTERNAL_HOSTNAME')}/webhook"
-        )
+        asyncio.run(run_webhook_server(application))
     except Exception as e:
         logger.error(f"Ошибка при запуске приложения: {e}")
         raise